@@ -27,14 +27,30 @@ unobtrusive. Useful for maintaining lightweight backups.
 
 Maintained at https://github.com/jonsim/tiny-backup
 """
+from __future__ import print_function
 import argparse     # ArgumentParser
-import ConfigParser # SafeConfigParser
+try:
+    from configparser import ConfigParser # Python 3
+except ImportError:
+    from ConfigParser import SafeConfigParser as ConfigParser # Python 2
+import contextlib   # contextmanager
+import errno        # EEXIST
+import itertools    # count
+import locale       # getpreferredencoding
+import multiprocessing # cpu_count
 import os           # makedirs
 import os.path      # exists, isfile, isdir, expanduser
-import subprocess   # check_output
-import shutil       # rmtree
+import re           # search
+import shutil       # copy2, copystat, rmtree
+import stat         # S_ISDIR, S_ISLNK, S_ISREG
+import subprocess   # check_call, check_output, Popen
 import sys          # stdout
-import tempfile     # mkdtemp
+try:
+    from StringIO import StringIO # Python 2
+except ImportError:
+    from io import StringIO # Python 3
+import tempfile     # NamedTemporaryFile
+import time         # strftime
 
 __version__ = '1.0.0'
 
@@ -43,27 +59,197 @@ SRC_KEY = 'src'
 ARCHIVE_KEY = 'archive'
 COMPRESS_KEY = 'compress'
 ENCRYPT_KEY = 'encrypt'
+COMPRESSOR_KEY = 'compressor'
+INCREMENTAL_KEY = 'incremental'
 DEFAULTS = {
     ARCHIVE_KEY: 'no',
     COMPRESS_KEY: 'no',
     ENCRYPT_KEY: 'no',
+    COMPRESSOR_KEY: 'xz',
+    INCREMENTAL_KEY: 'no',
 }
 
-_TEMPDIR = None
+# Map of supported compressors to the file extension they produce.
+COMPRESSORS = {
+    'xz': 'xz',
+    'zstd': 'zst',
+}
+
+def _stat_kind(path):
+    """
+    Determines the kind of a path with a single stat call.
+
+    Args:
+        path:   string path to stat.
+
+    Returns:
+        tuple of booleans: whether the path exists, whether it is a directory
+        and whether it is a regular file.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return (False, False, False)
+    return (True, stat.S_ISDIR(mode), stat.S_ISREG(mode))
 
-def make_tempdir():
+def find_executable(name):
     """
-    Retrieves a temporary directory, creating it if necessary.
+    Searches the $PATH for an executable.
+
+    Args:
+        name:   string name of the executable to find.
 
     Returns:
-        string path to a temporary directory.
+        string path to the executable, or None if it could not be found.
     """
-    global _TEMPDIR
-    if not _TEMPDIR:
-        _TEMPDIR = tempfile.mkdtemp()
-    return _TEMPDIR
+    for path_dir in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(path_dir, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
 
-def archive_path(dest, src, excludes=None, verbose=False):
+def run_command(cmd):
+    """
+    Runs a command, streaming its stdout straight to sys.stdout. If sys.stdout
+    is not backed by a file descriptor (e.g. it has been replaced by a StringIO)
+    the output is instead collected and written once the command completes.
+
+    Args:
+        cmd:    list of strings forming the command to run.
+
+    Raises:
+        CalledProcessError: if the command fails for any reason.
+    """
+    try:
+        stdout_fd = sys.stdout.fileno()
+    except (AttributeError, IOError, ValueError):
+        sys.stdout.write(subprocess.check_output(cmd, universal_newlines=True))
+        return
+    sys.stdout.flush()
+    subprocess.check_call(cmd, stdout=stdout_fd, close_fds=True)
+
+@contextlib.contextmanager
+def _exclude_file(excludes):
+    """
+    Context manager which writes a list of exclude patterns to a temporary file,
+    one per line, suitable for passing to both tar and rsync's --exclude-from,
+    and removes it on exit.
+
+    Args:
+        excludes:   list of strings of paths to exclude. May be None or an empty
+            list, in which case no file is created.
+
+    Yields:
+        string path to the exclude file, or None if there are no excludes.
+    """
+    if not excludes:
+        yield None
+        return
+    exclude_file = tempfile.NamedTemporaryFile('w', prefix='backup-excludes-',
+                                               delete=False)
+    try:
+        with exclude_file:
+            exclude_file.write('\n'.join(excludes) + '\n')
+        yield exclude_file.name
+    finally:
+        os.remove(exclude_file.name)
+
+@contextlib.contextmanager
+def _atomic_open(dest):
+    """
+    Context manager which opens a file to be atomically written at a path. The
+    file is written under a temporary name in the same directory and only
+    renamed over the destination once the block exits successfully, so a
+    failure part way through never leaves a truncated destination file.
+
+    Args:
+        dest:       string path for the destination file.
+
+    Yields:
+        file object opened for binary writing.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest),
+                                    prefix='.%s.' % (os.path.basename(dest)))
+    try:
+        # mkstemp creates files readable only by the owner; match open().
+        umask = os.umask(0)
+        os.umask(umask)
+        os.fchmod(fd, 0o666 & ~umask)
+        with os.fdopen(fd, 'wb') as dest_file:
+            yield dest_file
+        os.rename(tmp_path, dest)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+@contextlib.contextmanager
+def _staged_snapshot(snapshot):
+    """
+    Context manager which provides a working copy of a GNU tar snapshot file,
+    replacing the original with it only once the block exits successfully. This
+    stops a failed backup from recording changes which never made it into an
+    archive, which would cause the next incremental archive to omit them.
+
+    Args:
+        snapshot:   string path to the snapshot file, which need not exist. May
+            be None, in which case no working copy is made.
+
+    Yields:
+        string path to the working copy of the snapshot, or None if snapshot is
+        None.
+    """
+    if not snapshot:
+        yield None
+        return
+    stage_snapshot = snapshot + '.tmp'
+    if os.path.exists(snapshot):
+        shutil.copy2(snapshot, stage_snapshot)
+    try:
+        yield stage_snapshot
+        os.rename(stage_snapshot, snapshot)
+    except BaseException:
+        if os.path.exists(stage_snapshot):
+            os.remove(stage_snapshot)
+        raise
+
+def _archive_cmd(dest, src, exclude_from=None, snapshot=None, verbose=False):
+    """
+    Builds the 'tar' command to pack a file or directory into a .tar archive.
+
+    Args:
+        dest:       string path for the destination file for the archive, or
+            '-' to write the archive to stdout.
+        src:        string path for the source file or directory for the
+            archive.
+        exclude_from: string path to a file listing paths to exclude from the
+            archive, one per line. May be None to include all files from
+            source. Defaults to None.
+        snapshot:   string path to a GNU tar snapshot file to create an
+            incremental archive against, containing only what has changed since
+            the snapshot was last updated. The snapshot is created if it does
+            not exist (producing a full archive) and updated in place. May be
+            None to always create a full archive. Defaults to None.
+        verbose:    boolean, True to output verbose status. Defaults to False.
+
+    Returns:
+        list of strings forming the command.
+    """
+    cmd = ['tar']
+    cmd.append('--create')
+    if verbose:
+        cmd.append('--verbose')
+    if exclude_from:
+        cmd.append('--exclude-from=%s' % (exclude_from))
+    if snapshot:
+        cmd.append('--listed-incremental=%s' % (snapshot))
+    cmd.append('--file')
+    cmd.append(dest)
+    cmd.append('--directory')
+    cmd.append(os.path.dirname(src))
+    cmd.append(os.path.basename(src))
+    return cmd
+
+def archive_path(dest, src, excludes=None, snapshot=None, verbose=False):
     """
     Packs a file or directory into a .tar archive.
 
@@ -75,29 +261,23 @@ def archive_path(dest, src, excludes=None, verbose=False):
         excludes:   list of strings of paths to exclude from the archive. May be
             None or an empty list to include all files from source. Defaults to
             None.
+        snapshot:   string path to a GNU tar snapshot file to create an
+            incremental archive against. May be None to create a full archive.
+            Defaults to None.
         verbose:    boolean, True to output verbose status to stdout. Defaults
             to False.
 
     Raises:
         CalledProcessError: if the 'tar' command fails for any reason.
     """
-    assert dest and dest.endswith('.tar') and not os.path.isdir(dest) and \
+    assert dest and dest.endswith('.tar') and \
            os.path.isdir(os.path.dirname(dest))
     assert src and os.path.exists(src)
-    cmd = ['tar']
-    cmd.append('--create')
     if verbose:
-        print '\narchive_path(%s, %s)' % (dest, src)
-        cmd.append('--verbose')
-    if excludes:
-        for exclude in excludes:
-            cmd.append('--exclude=%s' % (exclude))
-    cmd.append('--file')
-    cmd.append(dest)
-    cmd.append('--directory')
-    cmd.append(os.path.dirname(src))
-    cmd.append(os.path.basename(src))
-    sys.stdout.write(subprocess.check_output(cmd))
+        print('\narchive_path(%s, %s)' % (dest, src))
+    with _exclude_file(excludes) as exclude_from:
+        run_command(_archive_cmd(dest, src, exclude_from=exclude_from,
+                                 snapshot=snapshot, verbose=verbose))
 
 def unarchive_path(dest, src, verbose=False):
     """
@@ -120,82 +300,265 @@ def unarchive_path(dest, src, verbose=False):
     cmd = ['tar']
     cmd.append('--extract')
     if verbose:
-        print '\nunarchive_path(%s, %s)' % (dest, src)
+        print('\nunarchive_path(%s, %s)' % (dest, src))
         cmd.append('--verbose')
     cmd.append('--file')
     cmd.append(src)
     cmd.append('--directory')
     cmd.append(dest)
-    sys.stdout.write(subprocess.check_output(cmd))
+    run_command(cmd)
+
+def _compress_cmd(threads=1, compressor='xz', verbose=False):
+    """
+    Builds the command to compress stdin to stdout. When compressing with xz,
+    pixz is used in preference to xz if it is available.
 
-def compress_path(dest, src, verbose=False):
+    Args:
+        threads:    int number of threads to compress with. May be 0 to use as
+            many threads as there are cores on the machine. Defaults to 1.
+        compressor: string name of the compressor to use, one of COMPRESSORS.
+            Defaults to 'xz'.
+        verbose:    boolean, True to output verbose status. Defaults to False.
+
+    Returns:
+        list of strings forming the command.
+    """
+    assert compressor in COMPRESSORS
+    if compressor == 'zstd':
+        cmd = ['zstd']
+        if verbose:
+            cmd.append('--verbose')
+        else:
+            cmd.append('--quiet')
+        cmd.append('--stdout')
+        cmd.append('-T%d' % (threads))
+        cmd.append('--long=27')         # Match xz's window for large inputs
+        cmd.append('-19')
+        cmd.append('--compress')
+    elif find_executable('pixz'):
+        # pixz has no quiet/verbose options.
+        cmd = ['pixz']
+        cmd.append('-t')                # Don't treat the input as a tarball
+        if threads:
+            cmd.append('-p')
+            cmd.append(str(threads))
+    else:
+        cmd = ['xz']
+        if verbose:
+            cmd.append('--verbose')
+        else:
+            cmd.append('--quiet')
+        cmd.append('--stdout')
+        cmd.append('--threads=%d' % (threads))
+        cmd.append('--compress')
+    return cmd
+
+def _uncompress_cmd(threads=1, compressor='xz', verbose=False):
+    """
+    Builds the command to uncompress stdin to stdout. When uncompressing with
+    xz, pixz is used in preference to xz if it is available.
+
+    Args:
+        threads:    int number of threads to uncompress with. May be 0 to use
+            as many threads as there are cores on the machine. Defaults to 1.
+        compressor: string name of the compressor the data was compressed with,
+            one of COMPRESSORS. Defaults to 'xz'.
+        verbose:    boolean, True to output verbose status. Defaults to False.
+
+    Returns:
+        list of strings forming the command.
+    """
+    assert compressor in COMPRESSORS
+    if compressor == 'zstd':
+        # zstd decompression is always single-threaded.
+        cmd = ['zstd']
+        if verbose:
+            cmd.append('--verbose')
+        else:
+            cmd.append('--quiet')
+        cmd.append('--stdout')
+        cmd.append('--long=27')
+        cmd.append('--decompress')
+    elif find_executable('pixz'):
+        cmd = ['pixz']
+        cmd.append('-d')
+        if threads:
+            cmd.append('-p')
+            cmd.append(str(threads))
+    else:
+        cmd = ['xz']
+        if verbose:
+            cmd.append('--verbose')
+        else:
+            cmd.append('--quiet')
+        cmd.append('--stdout')
+        cmd.append('--threads=%d' % (threads))
+        cmd.append('--decompress')
+    return cmd
+
+def compress_path(dest, src, threads=1, compressor='xz', verbose=False):
     """
-    Compresses a file into an xz-compressed file.
+    Compresses a file into an xz- or zstd-compressed file. When compressing
+    with xz, pixz is used in preference to xz if it is available.
 
     Args:
-        dest:       string path for the destination file. Must end with '.xz'.
+        dest:       string path for the destination file. Must end with the
+            compressor's extension ('.xz' or '.zst').
         src:        string path for the source file to compress.
+        threads:    int number of threads to compress with. May be 0 to use as
+            many threads as there are cores on the machine. Defaults to 1.
+        compressor: string name of the compressor to use, one of COMPRESSORS.
+            Defaults to 'xz'.
         verbose:    boolean, True to output verbose status to stdout. Defaults
             to False.
 
     Raises:
-        CalledProcessError: if the 'xz' command fails for any reason.
+        CalledProcessError: if the compression command fails for any reason.
     """
-    assert dest and dest.endswith('.xz') and not os.path.isdir(dest) and \
+    assert compressor in COMPRESSORS
+    assert dest and dest.endswith('.' + COMPRESSORS[compressor]) and \
            os.path.isdir(os.path.dirname(dest))
     assert src and os.path.isfile(src)
-    cmd = ['xz']
+    assert threads >= 0
     if verbose:
-        print '\ncompress_path(%s, %s)' % (dest, src)
-        cmd.append('--verbose')
-    else:
-        cmd.append('--quiet')
-    cmd.append('--keep')
-    cmd.append('--stdout')
-    cmd.append('--compress')
-    cmd.append(src)
-    try:
-        dest_file = open(dest, 'w')
-        subprocess.check_call(cmd, stdout=dest_file)
-    finally:
-        dest_file.close()
+        print('\ncompress_path(%s, %s)' % (dest, src))
+    cmd = _compress_cmd(threads=threads, compressor=compressor, verbose=verbose)
+    with open(src, 'rb') as src_file:
+        with _atomic_open(dest) as dest_file:
+            subprocess.check_call(cmd, stdin=src_file, stdout=dest_file)
 
-def uncompress_path(dest, src, verbose=False):
+def uncompress_path(dest, src, threads=1, compressor='xz', verbose=False):
     """
-    Uncompresses an xz-compressed file into it's original format.
+    Uncompresses an xz- or zstd-compressed file into it's original format. When
+    uncompressing with xz, pixz is used in preference to xz if it is available.
 
     Args:
         dest:       string path for the destination uncompressed file.
         src:        string path for the source compressed file. Must end with
-            '.xz'.
+            the compressor's extension ('.xz' or '.zst').
+        threads:    int number of threads to uncompress with. May be 0 to use
+            as many threads as there are cores on the machine. Only xz streams
+            compressed in multiple blocks can be uncompressed in parallel.
+            Defaults to 1.
+        compressor: string name of the compressor the file was compressed
+            with, one of COMPRESSORS. Defaults to 'xz'.
         verbose:    boolean, True to output verbose status to stdout. Defaults
             to False.
 
     Raises:
-        CalledProcessError: if the 'xz' command fails for any reason.
+        CalledProcessError: if the uncompression command fails for any reason.
     """
-    assert dest and not os.path.isdir(dest) and \
-           os.path.isdir(os.path.dirname(dest))
-    assert src and src.endswith('.xz') and os.path.isfile(src)
-    cmd = ['xz']
+    assert compressor in COMPRESSORS
+    assert dest and os.path.isdir(os.path.dirname(dest))
+    assert src and src.endswith('.' + COMPRESSORS[compressor]) and \
+           os.path.isfile(src)
+    assert threads >= 0
+    if verbose:
+        print('\nuncompress_path(%s, %s)' % (dest, src))
+    cmd = _uncompress_cmd(threads=threads, compressor=compressor,
+                          verbose=verbose)
+    with open(src, 'rb') as src_file:
+        with _atomic_open(dest) as dest_file:
+            subprocess.check_call(cmd, stdin=src_file, stdout=dest_file)
+
+# The (major, minor) version of the gpg on the $PATH, once determined.
+_gpg_version = None
+
+def _gpg_needs_loopback():
+    """
+    Determines whether the gpg on the $PATH (GnuPG >= 2.1) only reads a
+    passphrase from --passphrase-file when told not to ask pinentry for it. The
+    version is only queried once.
+
+    Returns:
+        boolean, True if '--pinentry-mode loopback' must be given.
+    """
+    global _gpg_version
+    if _gpg_version is None:
+        output = subprocess.check_output(['gpg', '--version'],
+                                         universal_newlines=True)
+        match = re.search(r'(\d+)\.(\d+)', output)
+        _gpg_version = (int(match.group(1)), int(match.group(2)))
+    return _gpg_version >= (2, 1)
+
+def gpg_cmd(homedir=None, passphrase_file=None, verbose=False):
+    """
+    Builds the start of a non-interactive 'gpg' command, up to its output and
+    operation. It always passes --batch, along with the passphrase arguments
+    the installed GPG version needs. It is public so that other tools (e.g. the
+    tests) can decrypt backup's output with the same arguments.
+
+    Args:
+        homedir:    string path for the location of the GPG home directory to
+            use. May be None to use the default location for the machine's GPG
+            implementation (typically ~/gnupg). Defaults to None.
+        passphrase_file: string path for a file containing the passphrase to
+            symmetrically encrypt or decrypt with. May be None to use the
+            default GPG key instead. Defaults to None.
+        verbose:    boolean, True to output verbose status. Defaults to False.
+
+    Returns:
+        list of strings forming the command.
+    """
+    cmd = ['gpg']
     if verbose:
-        print '\nuncompress_path(%s, %s)' % (dest, src)
         cmd.append('--verbose')
     else:
         cmd.append('--quiet')
-    cmd.append('--keep')
-    cmd.append('--stdout')
-    cmd.append('--decompress')
-    cmd.append(src)
-    try:
-        dest_file = open(dest, 'w')
-        subprocess.check_call(cmd, stdout=dest_file)
-    finally:
-        dest_file.close()
+    if homedir:
+        cmd.append('--homedir')
+        cmd.append(homedir)
+    cmd.append('--batch')
+    cmd.append('--no-tty')
+    if passphrase_file:
+        if _gpg_needs_loopback():
+            cmd.append('--pinentry-mode')
+            cmd.append('loopback')
+        cmd.append('--passphrase-file')
+        cmd.append(passphrase_file)
+    else:
+        cmd.append('--default-recipient-self')
+    return cmd
+
+def _encrypt_cmd(dest, src, homedir=None, passphrase_file=None, verbose=False):
+    """
+    Builds the 'gpg' command to encrypt a file into a gpg-encrypted file.
+
+    Args:
+        dest:       string path for the destination file, or '-' to write the
+            encrypted data to stdout.
+        src:        string path for the source file to encrypt, or None to
+            encrypt stdin.
+        homedir:    string path for the location of the GPG home directory to
+            use. May be None to use the default location for the machine's GPG
+            implementation (typically ~/gnupg). Defaults to None.
+        passphrase_file: string path for a file containing the passphrase to
+            symmetrically encrypt with (using AES256). May be None to encrypt
+            for the default GPG key instead. Defaults to None.
+        verbose:    boolean, True to output verbose status. Defaults to False.
 
-def encrypt_path(dest, src, homedir=None, verbose=False):
+    Returns:
+        list of strings forming the command.
     """
-    Encrypts a file into a gpg-encrypted file.
+    cmd = gpg_cmd(homedir=homedir, passphrase_file=passphrase_file,
+                  verbose=verbose)
+    cmd.append('--output')
+    cmd.append(dest)
+    if passphrase_file:
+        cmd.append('--cipher-algo')
+        cmd.append('AES256')
+        cmd.append('--symmetric')
+    else:
+        cmd.append('--encrypt')
+    if src:
+        cmd.append(src)
+    return cmd
+
+def encrypt_path(dest, src, homedir=None, passphrase_file=None,
+                 verbose=False):
+    """
+    Encrypts a file into a gpg-encrypted file. The destination is only
+    replaced once gpg succeeds, so a failed run never leaves a partial file.
 
     Args:
         dest:       string path for the destination file. Must end with '.gpg'.
@@ -203,34 +566,51 @@ def encrypt_path(dest, src, homedir=None, verbose=False):
         homedir:    string path for the location of the GPG home directory to
             use. May be None to use the default location for the machine's GPG
             implementation (typically ~/gnupg). Defaults to None.
+        passphrase_file: string path for a file containing the passphrase to
+            symmetrically encrypt with (using AES256). May be None to encrypt
+            for the default GPG key instead. Defaults to None.
         verbose:    boolean, True to output verbose status to stdout. Defaults
             to False.
 
     Raises:
         CalledProcessError: if the 'gpg' command fails for any reason.
     """
-    assert dest and dest.endswith('.gpg') and not os.path.isdir(dest) and \
+    assert dest and dest.endswith('.gpg') and \
            os.path.isdir(os.path.dirname(dest))
     assert src and os.path.isfile(src)
-    cmd = ['gpg']
     if verbose:
-        print '\nencrypt_path(%s, %s)' % (dest, src)
-        cmd.append('--verbose')
-    else:
-        cmd.append('--quiet')
+        print('\nencrypt_path(%s, %s)' % (dest, src))
+    cmd = _encrypt_cmd('-', src, homedir=homedir,
+                       passphrase_file=passphrase_file, verbose=verbose)
+    with _atomic_open(dest) as dest_file:
+        subprocess.check_call(cmd, stdout=dest_file)
+
+def _prime_gpg(homedir=None):
+    """
+    Runs a trivial gpg command so that the keyring is loaded and, for GPG
+    implementations which use one, gpg-agent is started once up front rather
+    than by the first of several encryption commands. Failures are ignored;
+    any real problem will be reported by the encryption itself.
+
+    Args:
+        homedir:    string path for the location of the GPG home directory to
+            use. May be None to use the default location for the machine's GPG
+            implementation (typically ~/gnupg). Defaults to None.
+    """
+    cmd = ['gpg', '--batch', '--no-tty', '--quiet']
     if homedir:
         cmd.append('--homedir')
         cmd.append(homedir)
-    cmd.append('--default-recipient-self')
-    cmd.append('--output')
-    cmd.append(dest)
-    cmd.append('--encrypt')
-    cmd.append(src)
-    sys.stdout.write(subprocess.check_output(cmd))
+    cmd.append('--list-secret-keys')
+    with open(os.devnull, 'wb') as devnull:
+        subprocess.call(cmd, stdout=devnull, stderr=devnull, close_fds=True)
 
-def unencrypt_path(dest, src, homedir=None, verbose=False):
+def unencrypt_path(dest, src, homedir=None, passphrase_file=None,
+                   verbose=False):
     """
-    Decrypts a gpg-encrypted file into its original format.
+    Decrypts a gpg-encrypted file into its original format. The destination
+    is only replaced once gpg succeeds, so a failed run never leaves a partial
+    file.
 
     Args:
         dest:       string path for the destination decrypted file.
@@ -239,37 +619,144 @@ def unencrypt_path(dest, src, homedir=None, verbose=False):
         homedir:    string path for the location of the GPG home directory to
             use. May be None to use the default location for the machine's GPG
             implementation (typically ~/gnupg). Defaults to None.
+        passphrase_file: string path for a file containing the passphrase the
+            file was symmetrically encrypted with. May be None if it was
+            encrypted for the default GPG key. Defaults to None.
         verbose:    boolean, True to output verbose status to stdout. Defaults
             to False.
 
     Raises:
         CalledProcessError: if the 'gpg' command fails for any reason.
     """
-    assert dest and not os.path.isdir(dest)and \
-           os.path.isdir(os.path.dirname(dest))
+    assert dest and os.path.isdir(os.path.dirname(dest))
     assert src and src.endswith('.gpg') and os.path.isfile(src)
-    cmd = ['gpg']
     if verbose:
-        print '\nunencrypt_path(%s, %s)' % (dest, src)
-        cmd.append('--verbose')
-    else:
-        cmd.append('--quiet')
-    if homedir:
-        cmd.append('--homedir')
-        cmd.append(homedir)
-    cmd.append('--default-recipient-self')
+        print('\nunencrypt_path(%s, %s)' % (dest, src))
+    cmd = gpg_cmd(homedir=homedir, passphrase_file=passphrase_file,
+                  verbose=verbose)
     cmd.append('--output')
-    cmd.append(dest)
+    cmd.append('-')
     cmd.append('--decrypt')
     cmd.append(src)
-    sys.stdout.write(subprocess.check_output(cmd))
+    with _atomic_open(dest) as dest_file:
+        subprocess.check_call(cmd, stdout=dest_file)
+
+def _is_remote_path(path):
+    """
+    Determines whether a path refers to a remote host in the manner of rsync,
+    i.e. it contains a colon before any slash.
+
+    Args:
+        path:   string path to check.
+
+    Returns:
+        boolean, True if the path is remote.
+    """
+    colon = path.find(':')
+    slash = path.find('/')
+    return colon != -1 and (slash == -1 or colon < slash)
+
+def _remove_path(path):
+    """
+    Removes a file, symlink or directory tree.
+
+    Args:
+        path:   string path to remove.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+def _drop_cache(path):
+    """
+    Advises the kernel that a file's cached pages will not be needed again, so
+    that backing up a large tree does not evict more useful data from the page
+    cache. Only clean pages (e.g. those of a file just read) are dropped. Does
+    nothing where posix_fadvise is unavailable (Python < 3.3 or a non-POSIX
+    platform).
+
+    Args:
+        path:   string path of the file whose cached pages may be dropped.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def _mirror_path(dest, src, verbose=False):
+    """
+    Mirrors a local file, symlink or directory tree to another local path in the
+    manner of 'rsync --archive --delete'. Files whose size and modification
+    time match the destination are skipped and anything in the destination not
+    in the source is removed. Special files (devices, FIFOs and sockets) are
+    not copied.
+
+    Args:
+        dest:       string path for the destination copied file or directory.
+        src:        string path for the source file or directory to copy.
+        verbose:    boolean, True to output each copied path to stdout.
+            Defaults to False.
+    """
+    src_stat = os.lstat(src)
+    try:
+        dest_stat = os.lstat(dest)
+    except OSError:
+        dest_stat = None
+
+    if stat.S_ISDIR(src_stat.st_mode):
+        if dest_stat and not stat.S_ISDIR(dest_stat.st_mode):
+            _remove_path(dest)
+            dest_stat = None
+        if not dest_stat:
+            os.mkdir(dest)
+        names = os.listdir(src)
+        for name in set(os.listdir(dest)).difference(names):
+            _remove_path(os.path.join(dest, name))
+        for name in names:
+            _mirror_path(os.path.join(dest, name), os.path.join(src, name),
+                         verbose=verbose)
+        shutil.copystat(src, dest)
+    elif stat.S_ISLNK(src_stat.st_mode):
+        link = os.readlink(src)
+        if dest_stat:
+            if stat.S_ISLNK(dest_stat.st_mode) and os.readlink(dest) == link:
+                return
+            _remove_path(dest)
+        if verbose:
+            print(dest)
+        os.symlink(link, dest)
+    elif stat.S_ISREG(src_stat.st_mode):
+        if dest_stat:
+            if stat.S_ISREG(dest_stat.st_mode) and \
+               dest_stat.st_size == src_stat.st_size and \
+               int(dest_stat.st_mtime) == int(src_stat.st_mtime):
+                return
+            _remove_path(dest)
+        if verbose:
+            print(dest)
+        # On Python >= 3.8 this uses the kernel's zero-copy fast paths.
+        shutil.copy2(src, dest)
+        # Only the source's (clean) pages can be dropped. The copy's pages are
+        # still dirty, and the kernel won't drop them until written back.
+        _drop_cache(src)
+    else:
+        return
+    if os.geteuid() == 0:
+        os.lchown(dest, src_stat.st_uid, src_stat.st_gid)
 
 def copy_path(dest, src, excludes=None, verbose=False):
     """
-    Copies a path to another location.
+    Copies a path to another location. Local copies are made directly, while
+    copies with excludes or to or from a remote host use rsync.
 
     Args:
         dest:       string path for the destination copied file or directory.
+            If this is an existing directory, or the source is a directory, the
+            source is copied into it.
         src:        string path for the source file or directory to copy.
         excludes:   list of strings of paths to exclude from the copy. May be
             None or an empty list to include all files from source. Defaults to
@@ -280,39 +767,164 @@ def copy_path(dest, src, excludes=None, verbose=False):
     Raises:
         CalledProcessError: if the 'rsync' command fails for any reason.
     """
-    assert dest and os.path.isdir(os.path.dirname(dest))
-    assert src and os.path.exists(src)
-    cmd = ['rsync']
+    remote = _is_remote_path(dest) or _is_remote_path(src)
+    if not remote:
+        src_exists, src_is_dir, _ = _stat_kind(src)
+        dest_exists, dest_is_dir, _ = _stat_kind(dest)
+        assert dest and (dest_exists or os.path.isdir(os.path.dirname(dest)))
+        assert src and src_exists
+    if verbose:
+        print('\ncopy_path(%s, %s)' % (dest, src))
+    if not remote and not excludes:
+        if src_is_dir or dest_is_dir:
+            if not dest_is_dir:
+                os.mkdir(dest)
+            dest = os.path.join(dest, os.path.basename(src))
+        _mirror_path(dest, src, verbose=verbose)
+        return
+    # Run rsync under nocache, if available, so the copy does not evict more
+    # useful data from the page cache.
+    cmd = ['nocache'] if find_executable('nocache') else []
+    cmd.append('rsync')
     if verbose:
-        print '\ncopy_path(%s, %s)' % (dest, src)
         cmd.append('--verbose')
     else:
         cmd.append('--quiet')
     cmd.append('--archive')         # Preserve metadata (-a)
     cmd.append('--delete')          # Delete extra files
-    cmd.append('--compress')        # Compress xfer data (-z)
+    if remote:
+        cmd.append('--compress')    # Compress xfer data (-z)
     cmd.append('--protect-args')    # Preserve whitespace (-s)
-    if excludes:
-        for exclude in excludes:
-            cmd.append('--filter=exclude_%s' % (exclude))
-    cmd.append(src)
-    cmd.append(dest)
-    sys.stdout.write(subprocess.check_output(cmd))
+    with _exclude_file(excludes) as exclude_from:
+        if exclude_from:
+            cmd.append('--exclude-from=%s' % (exclude_from))
+        cmd.append(src)
+        cmd.append(dest)
+        run_command(cmd)
 
-def resolve_relative_path(path, config_path):
+def pipeline_path(dest, src, archive=False, compress=False, encrypt=False,
+                  excludes=None, snapshot=None, threads=1, compressor='xz',
+                  homedir=None, passphrase_file=None, verbose=False):
+    """
+    Archives, compresses and/or encrypts a file or directory in a single pass by
+    streaming the output of each stage directly into the next, without writing
+    any intermediate files.
+
+    Args:
+        dest:       string path for the destination file.
+        src:        string path for the source file or directory. Must be a
+            file unless archiving.
+        archive:    boolean, True to pack the source into a .tar archive.
+            Defaults to False.
+        compress:   boolean, True to compress the data. Defaults to False.
+        encrypt:    boolean, True to gpg-encrypt the data. Defaults to False.
+        excludes:   list of strings of paths to exclude from the archive. May be
+            None or an empty list to include all files from source. Defaults to
+            None.
+        snapshot:   string path to a GNU tar snapshot file to create an
+            incremental archive against. May be None to create a full archive.
+            Defaults to None.
+        threads:    int number of threads to compress with. May be 0 to use as
+            many threads as there are cores on the machine. Defaults to 1.
+        compressor: string name of the compressor to use, one of COMPRESSORS.
+            Defaults to 'xz'.
+        homedir:    string path for the location of the GPG home directory to
+            use. May be None to use the default location for the machine's GPG
+            implementation (typically ~/gnupg). Defaults to None.
+        passphrase_file: string path for a file containing the passphrase to
+            symmetrically encrypt with (using AES256). May be None to encrypt
+            for the default GPG key instead. Defaults to None.
+        verbose:    boolean, True to output verbose status to stdout. Defaults
+            to False.
+
+    Raises:
+        CalledProcessError: if any command in the pipeline fails for any reason.
+    """
+    assert dest and os.path.isdir(os.path.dirname(dest))
+    src_exists, _, src_is_file = _stat_kind(src)
+    assert src and (src_is_file or (archive and src_exists))
+    assert archive or compress or encrypt
+    if verbose:
+        print('\npipeline_path(%s, %s)' % (dest, src))
+    with _exclude_file(excludes) as exclude_from:
+        cmds = []
+        if archive:
+            cmds.append(_archive_cmd('-', src, exclude_from=exclude_from,
+                                     snapshot=snapshot, verbose=verbose))
+        if compress:
+            cmds.append(_compress_cmd(threads=threads, compressor=compressor,
+                                      verbose=verbose))
+        if encrypt:
+            cmds.append(_encrypt_cmd('-', None, homedir=homedir,
+                                     passphrase_file=passphrase_file,
+                                     verbose=verbose))
+
+        # Start each stage reading from the previous one, closing the parent's
+        # copy of each pipe as it is handed on so stages see EOF and SIGPIPE
+        # correctly. tar writes its verbose listing to stderr when archiving to
+        # stdout, so that is piped back too, to be written to sys.stdout.
+        pipe_listing = archive and verbose
+        procs = []
+        with open(os.devnull if archive else src, 'rb') as src_file:
+            with _atomic_open(dest) as dest_file:
+                stdin = src_file
+                try:
+                    for cmd in cmds:
+                        stdout = (dest_file if cmd is cmds[-1] else
+                                  subprocess.PIPE)
+                        stderr = (subprocess.PIPE if pipe_listing and
+                                  cmd is cmds[0] else None)
+                        proc = subprocess.Popen(cmd, stdin=stdin, stdout=stdout,
+                                                stderr=stderr)
+                        if procs:
+                            stdin.close()
+                        procs.append(proc)
+                        stdin = proc.stdout
+                except BaseException:
+                    # A later stage failed to start (e.g. its tool is missing),
+                    # so stop the stages already started rather than leave them
+                    # blocked on their pipes.
+                    for proc in procs:
+                        for pipe in (proc.stdout, proc.stderr):
+                            if pipe:
+                                pipe.close()
+                        proc.kill()
+                        proc.wait()
+                    raise
+
+                # The listing ends when tar exits, and the later stages never
+                # wait on this process, so it is read out before waiting.
+                if pipe_listing:
+                    with procs[0].stderr as listing:
+                        for line in iter(listing.readline, b''):
+                            if not isinstance(line, str):
+                                line = line.decode(
+                                    locale.getpreferredencoding(False),
+                                    'replace')
+                            sys.stdout.write(line)
+
+                # Report the last failing stage, since earlier stages may have
+                # only failed as a result of a later one exiting.
+                returncodes = [proc.wait() for proc in reversed(procs)]
+                for cmd, returncode in zip(reversed(cmds), returncodes):
+                    if returncode:
+                        raise subprocess.CalledProcessError(returncode, cmd)
+
+def resolve_relative_path(path, config_dir):
     """
     Resolves relative paths into absolute paths relative to the config file.
 
     Args:
         path:           string (potentially) relative path to resolve.
-        config_path:    string path to the config file to resolve relative to.
+        config_dir:     string path to the directory containing the config file
+            to resolve relative to.
 
     Returns:
         string absolute path (unaltered if 'path' was already absolute).
     """
     if os.path.isabs(path):
         return path
-    return os.path.join(os.path.dirname(config_path), path)
+    return os.path.join(config_dir, path)
 
 def get_out_filename(dirname, src, extension):
     """
@@ -328,75 +940,210 @@ def get_out_filename(dirname, src, extension):
     """
     return os.path.join(dirname, '%s.%s' % (os.path.basename(src), extension))
 
-def process_section(config, section, config_path, verbose=False, gpg_home=None):
+def reserve_out_filename(dirname, src, extension):
     """
-    Process a config file section and perform the actions it describes.
+    Forms a timestamped filename from a dir-name, file-name and file-extension
+    and reserves it by creating an empty file there, so it can never overwrite
+    an existing file. If the name is taken (e.g. by an earlier backup in the
+    same second) a sequence number is appended to the timestamp, in a form
+    which still sorts after it.
+
+    Args:
+        dirname:    string path to directory to use.
+        src:        string path to file whose basename to use.
+        extension:  string file extension (without preceding '.') to use after
+            the timestamp.
+
+    Returns:
+        string path of the reserved (empty) file.
+
+    Raises:
+        OSError:    if the file cannot be created for any reason other than its
+            name being taken.
+    """
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    for seq in itertools.count():
+        name = stamp if not seq else '%s_%02d' % (stamp, seq)
+        path = get_out_filename(dirname, src, '%s.%s' % (name, extension))
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+            continue
+        os.close(fd)
+        return path
+
+def parse_section(config, section, config_dir):
+    """
+    Reads a config file section into a description of the actions to perform.
 
     Args:
         config:         ConfigParser to read the section from.
         section:        string section name to read from the ConfigParser.
-        config_path:    string path to the read config file.
+        config_dir:     string path to the directory containing the read config
+            file.
+
+    Returns:
+        dict mapping each of SRC_KEY and DEST_KEY to a string absolute path,
+        each of ARCHIVE_KEY, COMPRESS_KEY, ENCRYPT_KEY and INCREMENTAL_KEY to a
+        boolean and COMPRESSOR_KEY to a string name from COMPRESSORS.
+
+    Raises:
+        ValueError: if the section names an unsupported compressor.
+    """
+    if config.has_option(section, SRC_KEY):
+        src = config.get(section, SRC_KEY)
+    else:
+        src = section
+    compressor = config.get(section, COMPRESSOR_KEY)
+    if compressor not in COMPRESSORS:
+        raise ValueError('Unsupported compressor "%s" in section "%s".' %
+                         (compressor, section))
+    return {
+        SRC_KEY: resolve_relative_path(src, config_dir),
+        DEST_KEY: resolve_relative_path(config.get(section, DEST_KEY),
+                                        config_dir),
+        ARCHIVE_KEY: config.getboolean(section, ARCHIVE_KEY),
+        COMPRESS_KEY: config.getboolean(section, COMPRESS_KEY),
+        ENCRYPT_KEY: config.getboolean(section, ENCRYPT_KEY),
+        COMPRESSOR_KEY: compressor,
+        INCREMENTAL_KEY: config.getboolean(section, INCREMENTAL_KEY),
+    }
+
+def process_section(section, verbose=False, gpg_home=None,
+                    passphrase_file=None, compress_threads=1):
+    """
+    Process a config file section and perform the actions it describes.
+
+    Args:
+        section:        dict describing the section, as returned by
+            parse_section.
         verbose:        boolean, True to output verbose status to stdout.
             Defaults to False.
         gpg_home:       string path for the location of the GPG home directory
             to use. May be None to use the default location for the machine's
             GPG implementation (typically ~/gnupg). Defaults to None.
+        passphrase_file: string path for a file containing the passphrase to
+            symmetrically encrypt with (using AES256). May be None to encrypt
+            for the default GPG key instead. Defaults to None.
+        compress_threads: int number of threads to compress with. May be 0 to
+            use as many threads as there are cores on the machine. Defaults to
+            1.
 
     Raises:
         OSError:    if the source path given in the section does not exist.
     """
-    # Extract fields from the section (and write-back any missing).
-    if not config.has_option(section, SRC_KEY):
-        config.set(section, SRC_KEY, section)
-    pipeline_src = resolve_relative_path(config.get(section, SRC_KEY), config_path)
-    pipeline_dest = resolve_relative_path(config.get(section, DEST_KEY), config_path)
-    archive = config.getboolean(section, ARCHIVE_KEY)
-    compress = config.getboolean(section, COMPRESS_KEY)
-    encrypt = config.getboolean(section, ENCRYPT_KEY)
+    pipeline_src = section[SRC_KEY]
+    pipeline_dest = section[DEST_KEY]
+    archive = section[ARCHIVE_KEY]
+    compress = section[COMPRESS_KEY]
+    encrypt = section[ENCRYPT_KEY]
+    compressor = section[COMPRESSOR_KEY]
+    incremental = section[INCREMENTAL_KEY]
 
     # Validate args.
-    if not os.path.exists(pipeline_src):
+    src_exists, src_is_dir, _ = _stat_kind(pipeline_src)
+    if not src_exists:
         raise OSError("Source path %s does not exist." % (pipeline_src))
     if not os.path.exists(pipeline_dest):
         os.makedirs(pipeline_dest)
-    if (compress or encrypt) and os.path.isdir(pipeline_src):
+    if ((compress or encrypt) and src_is_dir) or incremental:
         archive = True
 
-    # Perform backup pipeline.
-    stage_src = pipeline_src
-    if archive or compress or encrypt:
-        tempdir = make_tempdir()
-
-        if archive:
-            stage_dest = get_out_filename(tempdir, stage_src, 'tar')
-            archive_path(stage_dest, stage_src, verbose=verbose)
-            stage_src = stage_dest
+    # Perform backup pipeline. Any processing writes its output straight into
+    # the destination, so only an unprocessed source needs copying.
+    extensions = []
+    if archive:
+        extensions.append('tar')
+    if compress:
+        extensions.append(COMPRESSORS[compressor])
+    if encrypt:
+        extensions.append('gpg')
+    if not extensions:
+        copy_path(pipeline_dest, pipeline_src, verbose=verbose)
+        return
+    extension = '.'.join(extensions)
+    snapshot = None
+    if incremental:
+        # Each incremental archive gets a new timestamped name so it never
+        # overwrites the full archive, or earlier incrementals, that it builds
+        # upon. The snapshot is kept next to them, unencrypted, as tar must
+        # read it to make the next archive.
+        snapshot = get_out_filename(pipeline_dest, pipeline_src, 'snar')
+        stage_dest = reserve_out_filename(pipeline_dest, pipeline_src,
+                                          extension)
+    else:
+        stage_dest = get_out_filename(pipeline_dest, pipeline_src, extension)
+    try:
+        with _staged_snapshot(snapshot) as stage_snapshot:
+            if len(extensions) > 1:
+                pipeline_path(stage_dest, pipeline_src, archive=archive,
+                              compress=compress, encrypt=encrypt,
+                              snapshot=stage_snapshot, threads=compress_threads,
+                              compressor=compressor, homedir=gpg_home,
+                              passphrase_file=passphrase_file, verbose=verbose)
+            elif archive:
+                archive_path(stage_dest, pipeline_src, snapshot=stage_snapshot,
+                             verbose=verbose)
+            elif compress:
+                compress_path(stage_dest, pipeline_src,
+                              threads=compress_threads, compressor=compressor,
+                              verbose=verbose)
+            else:
+                encrypt_path(stage_dest, pipeline_src, verbose=verbose,
+                             homedir=gpg_home, passphrase_file=passphrase_file)
+    except BaseException:
+        # Don't leave a reserved name (or partial archive) behind.
+        if incremental and os.path.exists(stage_dest):
+            os.remove(stage_dest)
+        raise
 
-        if compress:
-            stage_dest = get_out_filename(tempdir, stage_src, 'xz')
-            compress_path(stage_dest, stage_src, verbose=verbose)
-            stage_src = stage_dest
+def _process_section_worker(kwargs):
+    """
+    Calls process_section from a multiprocessing worker. Its stdout output is
+    collected rather than written to the stdout the worker inherited, so that
+    the caller can write each section's output whole and in order to its own
+    sys.stdout.
 
-        if encrypt:
-            stage_dest = get_out_filename(tempdir, stage_src, 'gpg')
-            encrypt_path(stage_dest, stage_src, verbose=verbose, homedir=gpg_home)
-            stage_src = stage_dest
+    Args:
+        kwargs: dict of keyword arguments to pass to process_section.
 
-    # Perform copy.
-    copy_path(pipeline_dest, stage_src, verbose=verbose)
+    Returns:
+        tuple of the string output process_section wrote to stdout and the
+        error it raised, for the caller to re-raise. The error is None if the
+        section was processed successfully, a tuple of the returncode and cmd
+        of a CalledProcessError (which cannot be unpickled on Python 2), or
+        otherwise the exception itself.
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        try:
+            process_section(**kwargs)
+            error = None
+        except subprocess.CalledProcessError as err:
+            error = (err.returncode, err.cmd)
+        except Exception as err:
+            error = err
+        return sys.stdout.getvalue(), error
+    finally:
+        sys.stdout = stdout
 
-def main(argv=None):
-    """Main method.
+# The command line parser, once created by _get_parser.
+_parser = None
 
-    Args:
-        argv:   list of strings to pass through to the ArgumentParser. If None
-            will pass through sys.argv instead. Defaults to None.
+def _get_parser():
+    """
+    Retrieves the command line parser, creating it on first use so repeated
+    calls to main (e.g. from the tests) share it.
 
-    Raises:
-        OSError:    if the config file path given does not exist.
+    Returns:
+        argparse.ArgumentParser for the command line.
     """
-    global _TEMPDIR
-    # Handle command line.
+    global _parser
+    if _parser is not None:
+        return _parser
     parser = argparse.ArgumentParser(description='A micro backup manager, '
                                      'designed to be lightly configurable, '
                                      'simple and unobtrusive. Useful for '
@@ -405,11 +1152,28 @@ def main(argv=None):
                         type=str, default='~/.backup_config',
                         help='The location of the backup config file to read. '
                         'Defaults to %(default)s')
+    parser.add_argument('--compress-threads', metavar='N',
+                        type=int, default=None,
+                        help='The number of threads each config file section '
+                        'uses if compressing data. May be 0 to use one per '
+                        'core. Defaults to the number of cores on the machine '
+                        'divided between the sections processed in parallel.')
     parser.add_argument('--gpg-home', metavar='PATH',
                         type=str, default=None,
                         help='The location of the GPG home directory to use if '
                         'encrypting data. Defaults to that of the machine\'s '
                         'GPG implementation (typically ~/gnupg).')
+    parser.add_argument('--passphrase-file', metavar='PATH',
+                        type=str, default=None,
+                        help='A file whose first line is a passphrase to '
+                        'symmetrically encrypt data with (using AES256), '
+                        'rather than encrypting it for the default GPG key.')
+    parser.add_argument('--jobs', metavar='N',
+                        type=int, default=None,
+                        help='The number of config file sections to process '
+                        'in parallel. Defaults to the number of sections or '
+                        'the number of cores on the machine, whichever is '
+                        'fewer.')
     parser.add_argument('--restore',
                         action='store_true', default=False,
                         help='Reverse the backup process to restore the local '
@@ -424,31 +1188,88 @@ def main(argv=None):
                         help='Print additional output.')
     parser.add_argument('--version',
                         action='version', version='%(prog)s ' + __version__)
-    args = parser.parse_args(args=argv)
+    _parser = parser
+    return parser
+
+def main(argv=None):
+    """Main method.
+
+    Args:
+        argv:   list of strings to pass through to the ArgumentParser. If None
+            will pass through sys.argv instead. Defaults to None.
+
+    Raises:
+        OSError:    if the config file or passphrase file path given does not
+            exist.
+        IOError:    if the config file cannot be read.
+    """
+    # Handle command line.
+    args = _get_parser().parse_args(args=argv)
 
     # Process command line.
     if args.restore:
         raise NotImplementedError('Restore functionality is not implemented.')
     if args.retention != 1:
         raise NotImplementedError('Retention functionality is not implemented')
+    if args.compress_threads is not None and args.compress_threads < 0:
+        raise ValueError('--compress-threads must not be negative.')
+    if args.jobs is not None and args.jobs < 1:
+        raise ValueError('--jobs must be at least 1.')
 
     # Parse the config file.
     args.config = os.path.expanduser(args.config)
     if not os.path.isfile(args.config):
         raise OSError('Config file "%s" does not exist.' % (args.config))
-    config = ConfigParser.SafeConfigParser(DEFAULTS)
+    config = ConfigParser(DEFAULTS)
+    # Open the file explicitly, as read() silently skips unreadable files.
     with open(args.config) as config_file:
-        config.readfp(config_file)
+        if hasattr(config, 'read_file'):
+            config.read_file(config_file) # Python 3
+        else:
+            config.readfp(config_file) # Python 2
+    if args.passphrase_file:
+        args.passphrase_file = os.path.expanduser(args.passphrase_file)
+        if not os.path.isfile(args.passphrase_file):
+            raise OSError('Passphrase file "%s" does not exist.' %
+                          (args.passphrase_file))
 
-    # Perform the backup.
+    # Perform the backup. Unless told otherwise, the sections processed in
+    # parallel share the cores between their compressors rather than each
+    # starting a thread per core.
+    sections = config.sections()
+    jobs = args.jobs
+    if jobs is None:
+        jobs = min(len(sections), multiprocessing.cpu_count())
+    compress_threads = args.compress_threads
+    if compress_threads is None:
+        parallel = max(1, min(jobs, len(sections)))
+        compress_threads = max(1, multiprocessing.cpu_count() // parallel)
+    config_dir = os.path.dirname(args.config)
+    section_kwargs = [dict(section=parse_section(config, section, config_dir),
+                           verbose=args.verbose, gpg_home=args.gpg_home,
+                           passphrase_file=args.passphrase_file,
+                           compress_threads=compress_threads)
+                      for section in sections]
+    if sum(1 for kwargs in section_kwargs
+           if kwargs['section'][ENCRYPT_KEY]) > 1:
+        _prime_gpg(homedir=args.gpg_home)
+    if jobs <= 1:
+        for kwargs in section_kwargs:
+            process_section(**kwargs)
+        return
+    pool = multiprocessing.Pool(jobs)
     try:
-        for section in config.sections():
-            process_section(config, section, args.config, verbose=args.verbose,
-                            gpg_home=args.gpg_home)
+        results = pool.map(_process_section_worker, section_kwargs)
     finally:
-        if _TEMPDIR:
-            shutil.rmtree(_TEMPDIR)
-            _TEMPDIR = None
+        pool.close()
+        pool.join()
+    for output, _ in results:
+        sys.stdout.write(output)
+    for _, error in results:
+        if isinstance(error, tuple):
+            raise subprocess.CalledProcessError(*error)
+        elif error:
+            raise error
 
 # Entry point.
 if __name__ == "__main__":
@@ -27,21 +27,35 @@ System tests for tiny-backup.
 Maintained at https://github.com/jonsim/tiny-backup
 """
 import contextlib
+import glob
 import os
-import shutil
+import subprocess
 import sys
 import tempfile
 import unittest
-# To avoid having to make the parent directory a module just amend PYTHONPATH.
-sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import uuid
+try:
+    from StringIO import StringIO # Python 2
+except ImportError:
+    from io import StringIO # Python 3
+# To avoid having to make the parent directory a module just amend PYTHONPATH
+# (once, as both test modules are usually loaded together).
+_PARENT_DIR = os.path.join(sys.path[0], '..')
+if _PARENT_DIR not in sys.path:
+    sys.path.insert(1, _PARENT_DIR)
 import backup
 import test
 
+# The streams redir_stdstreams redirects to, reused between calls.
+_redir_stdout, _redir_stderr = StringIO(), StringIO()
+
 @contextlib.contextmanager
 def redir_stdstreams():
     """
     Context manager which redirects stdout and stderr for its duration and
-    yields the newly redirected versions.
+    yields the newly redirected versions. The same (emptied) streams are used
+    by every call, so their contents must be read before the next call and
+    calls must not be nested.
 
     This is taken from https://stackoverflow.com/a/17981937
 
@@ -51,8 +65,10 @@ def redir_stdstreams():
         stderr: redirected stderr (which will be equivalent to sys.stderr within
             the scope of this context manager).
     """
-    import StringIO
-    new_stdout, new_stderr = StringIO.StringIO(), StringIO.StringIO()
+    new_stdout, new_stderr = _redir_stdout, _redir_stderr
+    for stream in (new_stdout, new_stderr):
+        stream.seek(0)
+        stream.truncate(0)
     old_stdout, old_stderr = sys.stdout, sys.stderr
     try:
         sys.stdout, sys.stderr = new_stdout, new_stderr
@@ -60,11 +76,54 @@ def redir_stdstreams():
     finally:
         sys.stdout, sys.stderr = old_stdout, old_stderr
 
+# Maps the signature of a hashed path to its hash.
+_hash_cache = {}
+
+def _cached_file_hash(path):
+    """
+    Retrieves the hash of a file's contents, reusing a previous result if the
+    file has not changed since.
+
+    Args:
+        path:   string path of the file to hash.
+
+    Returns:
+        string hex digest.
+    """
+    key = ('file', test.stat_signature(path))
+    if key not in _hash_cache:
+        _hash_cache[key] = test.get_file_hash(path)
+    return _hash_cache[key]
+
+def _cached_dir_hash(path):
+    """
+    Retrieves the hash for a directory and all its contents, reusing a
+    previous result if nothing in the directory has changed since.
+
+    Args:
+        path:   string path of the directory to hash.
+
+    Returns:
+        string hex digest.
+    """
+    signature = []
+    for root, dirs, files in test.walk_dir(path):
+        rel_root = root[len(path):]
+        # Only the names of directories contribute to the hash.
+        signature.extend((os.path.join(rel_root, name), None) for name in dirs)
+        signature.extend((file_path[len(path):],
+                          test.stat_signature(file_path))
+                         for file_path in files)
+    key = ('dir', tuple(signature))
+    if key not in _hash_cache:
+        _hash_cache[key] = test.get_dir_hash(path)
+    return _hash_cache[key]
+
 class _ConfigSection(object):
     """A class wrapping a description of a config file section."""
 
     def __init__(self, section, dest, src=None, archive=None, compress=None,
-                 encrypt=None):
+                 encrypt=None, compressor=None, incremental=None):
         """Initialise the config file section description."""
         self.section = section
         self.dest = dest
@@ -72,6 +131,28 @@ class _ConfigSection(object):
         self.archive = archive
         self.compress = compress
         self.encrypt = encrypt
+        self.compressor = compressor
+        self.incremental = incremental
+
+def _format_config_section(section):
+    """
+    Formats a _ConfigSection as it would appear in a config file.
+
+    Args:
+        section:        _ConfigSection to format.
+
+    Returns:
+        string config file section.
+    """
+    lines = ['[%s]' % (section.section)]
+    if section.src:
+        lines.append('src = %s' % (section.src))
+    lines.append('dest = %s' % (section.dest))
+    for key in ['archive', 'compress', 'encrypt', 'compressor', 'incremental']:
+        value = getattr(section, key)
+        if value:
+            lines.append('%s = %s' % (key, value))
+    return '\n'.join(lines) + '\n\n'
 
 def _write_config_file(config_path, sections):
     """
@@ -81,23 +162,65 @@ def _write_config_file(config_path, sections):
         config_path:    string path to create the config file in.
         sections:       list of _ConfigSections to create the file from.
     """
+    contents = ''.join([_format_config_section(section)
+                        for section in sections])
     with open(config_path, 'w') as config_file:
-        for section in sections:
-            config_file.write('[%s]\n' % (section.section))
-            if section.src:
-                config_file.write('src = %s\n' % (section.src))
-            config_file.write('dest = %s\n' % (section.dest))
-            if section.archive:
-                config_file.write('archive = %s\n' % (section.archive))
-            if section.compress:
-                config_file.write('compress = %s\n' % (section.compress))
-            if section.encrypt:
-                config_file.write('encrypt = %s\n' % (section.encrypt))
-            config_file.write('\n')
+        config_file.write(contents)
 
 class TestBackupSystem(unittest.TestCase):
     """System tests TestCase"""
 
+    @classmethod
+    def setUpClass(cls):
+        """
+        Creates a root temporary directory to hold every test's temporary
+        directory and, within it, canonical copies of the test input which the
+        tests hardlink their (read-only) inputs to.
+        """
+        # Under pytest-xdist each worker process sets up the class itself, so
+        # also needs a GPG home directory of its own.
+        worker = os.environ.get('PYTEST_XDIST_WORKER')
+        cls._root = tempfile.mkdtemp(prefix='tb-%s-' % (worker or 'main'),
+                                     dir=test.TMP_ROOT)
+        if worker:
+            test.isolate_gpg_home(cls._root)
+        cls._canonical_in_dir = os.path.join(cls._root, 'canonical')
+        cls._canonical_file = os.path.join(cls._canonical_in_dir, 'file.txt')
+        cls._canonical_struct = os.path.join(cls._canonical_in_dir, 'struct')
+        os.mkdir(cls._canonical_in_dir)
+        test.create_ascii_file(cls._canonical_file)
+        test.create_test_structure(cls._canonical_struct)
+        # Run backup's argument parsing once up front so the first test doesn't
+        # pay for any one-off work it does (e.g. building its parser).
+        with redir_stdstreams():
+            try:
+                backup.main(['--help'])
+            except SystemExit:
+                pass
+        test.start_gpg_agent()
+
+    @classmethod
+    def tearDownClass(cls):
+        """
+        Stops any gpg-agent started by setUpClass and removes the root
+        temporary directory created by it, along with every test's temporary
+        directory within it. The tests leave their directories in place so the
+        whole tree is removed in one go by rm, which outpaces shutil.rmtree.
+        """
+        test.stop_gpg_agent()
+        subprocess.check_call(['rm', '-rf', cls._root])
+
+    def _create_tempdir(self):
+        """
+        Creates a new, empty temporary directory for a single test.
+
+        Returns:
+            string path to the temporary directory.
+        """
+        tempdir = os.path.join(self._root, uuid.uuid4().hex)
+        os.mkdir(tempdir)
+        return tempdir
+
     def _create_tempdir_structure(self, in_dirname, out_dirname):
         """
         Creates a temporary directory structure to hold system input and output.
@@ -111,7 +234,7 @@ class TestBackupSystem(unittest.TestCase):
             string path to directory for system input.
             string path to directory for system output.
         """
-        tempdir = tempfile.mkdtemp()
+        tempdir = self._create_tempdir()
         in_dir = os.path.join(tempdir, in_dirname)
         out_dir = os.path.join(tempdir, out_dirname)
         os.makedirs(in_dir)
@@ -140,7 +263,7 @@ class TestBackupSystem(unittest.TestCase):
         # Create files within the input structure.
         in_file = os.path.join(in_dir, in_filename)
         out_file = os.path.join(out_dir, out_filename)
-        test.create_ascii_file(in_file)
+        os.link(self._canonical_file, in_file)
 
         # Create the config file for this structure.
         cfg_file = os.path.join(cfg_dir, 'simple.cfg')
@@ -175,7 +298,7 @@ class TestBackupSystem(unittest.TestCase):
         # Create files within the input structure.
         in_struct = os.path.join(in_dir, in_dirname)
         out_struct = os.path.join(out_dir, out_dirname)
-        test.create_test_structure(in_struct)
+        test.clone_tree(self._canonical_struct, in_struct)
 
         # Create the config file for this structure.
         cfg_file = os.path.join(cfg_dir, 'simple.cfg')
@@ -188,364 +311,347 @@ class TestBackupSystem(unittest.TestCase):
 
         return in_struct, out_struct, cfg_file
 
+    def _run_backup(self, cfg_file, options):
+        """
+        Runs backup on a config file and asserts it produces no output. Any
+        encryption is symmetric, with test.PASSPHRASE_FILE.
+
+        Args:
+            cfg_file:   string path to the config file to run backup on.
+            options:    dict of the keyword _ConfigSection options the config
+                file was created with.
+        """
+        argv = ['--config', cfg_file]
+        if options.get('encrypt'):
+            argv += ['--gpg-home', test.GPG_HOME,
+                     '--passphrase-file', test.PASSPHRASE_FILE]
+        with redir_stdstreams() as (stdout, stderr):
+            backup.main(argv)
+        self.assertEqual('', stdout.getvalue().strip())
+        self.assertEqual('', stderr.getvalue().strip())
+
+    def _run_file_variant(self, out_filename, undo=None, runs=1, **options):
+        """
+        Backs up a single file and asserts the input is unchanged and that the
+        output restores to it.
+
+        Args:
+            out_filename:   string expected name of output file.
+            undo:           function taking a string path to a directory and
+                the string path to the output file, which restores the input
+                file into that directory. None if the output is a plain copy.
+            runs:           int number of times to back up the file, into the
+                same output directory. Defaults to 1.
+            options:        keyword _ConfigSection options for the file.
+        """
+        # Setup the test state.
+        tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
+            'output')
+        in_file, out_file, cfg_file = self._create_single_file_test(\
+            'file.txt', out_filename, tempdir, in_dir, out_dir, \
+            [_ConfigSection('input/file.txt', out_dir, **options)])
+        in_dir_hash = _cached_dir_hash(in_dir)
+        in_file_hash = _cached_file_hash(in_file)
+
+        # Run backup.
+        for _ in range(runs):
+            self._run_backup(cfg_file, options)
+
+        # Assert the output state looks as we expect.
+        self.assertTrue(os.path.isfile(in_file))
+        self.assertEqual([out_filename], os.listdir(out_dir))
+        self.assertEqual(in_dir_hash, _cached_dir_hash(in_dir))
+        if undo is None:
+            self.assertEqual(in_dir_hash, _cached_dir_hash(out_dir))
+        else:
+            undo(tempdir, out_file)
+            undo_out_file = os.path.join(tempdir, 'file.txt')
+            self.assertEqual(in_file_hash, _cached_file_hash(undo_out_file))
+
+    def _run_dir_variant(self, out_dirname, undo=None, **options):
+        """
+        Backs up a single directory and asserts the input is unchanged and that
+        the output restores to it.
+
+        Args:
+            out_dirname:    string expected name of output directory or file.
+            undo:           function taking a string path to a directory and
+                the string path to the output, which restores the input
+                directory into that directory. None if the output is a plain
+                copy.
+            options:        keyword _ConfigSection options for the directory.
+        """
+        # Setup the test state. Outputs which need restoring are written
+        # alongside the output directory and restored into it.
+        tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
+            'output')
+        dest = out_dir if undo is None else tempdir
+        in_struct, out_struct, cfg_file = self._create_single_dir_test(\
+            'struct', out_dirname, tempdir, in_dir, dest, \
+            [_ConfigSection('input/struct', dest, **options)])
+        in_dir_hash = _cached_dir_hash(in_dir)
+
+        # Run backup.
+        self._run_backup(cfg_file, options)
+
+        # Assert the output state looks as we expect.
+        self.assertEqual(in_dir_hash, _cached_dir_hash(in_dir))
+        if undo is not None:
+            self.assertTrue(os.path.isfile(out_struct))
+            undo(out_dir, out_struct)
+        self.assertEqual(in_dir_hash, _cached_dir_hash(out_dir))
+
     def test_file(self):
         """Most basic test of a single file backup."""
-        try:
-            # Setup the test state.
-            tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
-                'output')
-            in_file, out_file, cfg_file = self._create_single_file_test(\
-                'file.txt', 'file.txt', tempdir, in_dir, out_dir, \
-                [_ConfigSection('input/file.txt', out_dir)])
-            in_dir_hash = test.get_dir_md5(in_dir)
-
-            # Run backup.
-            with redir_stdstreams() as (stdout, stderr):
-                backup.main(['--config', cfg_file])
-            self.assertEqual('', stdout.getvalue().strip())
-            self.assertEqual('', stderr.getvalue().strip())
-
-            # Assert the output state looks as we expect.
-            self.assertTrue(os.path.isfile(in_file))
-            self.assertTrue(os.path.isfile(out_file))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(in_dir))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(out_dir))
-
-        finally:
-            shutil.rmtree(tempdir)
+        self._run_file_variant('file.txt')
 
     def test_file_archive(self):
         """Basic test of a single file archive and backup."""
-        try:
-            # Setup the test state.
-            tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
-                'output')
-            in_file, out_file, cfg_file = self._create_single_file_test(\
-                'file.txt', 'file.txt.tar', tempdir, in_dir, out_dir, \
-                [_ConfigSection('input/file.txt', out_dir, archive='yes')])
-            in_dir_hash = test.get_dir_md5(in_dir)
-            in_file_hash = test.get_file_md5(in_file)
-
-            # Run backup.
-            with redir_stdstreams() as (stdout, stderr):
-                backup.main(['--config', cfg_file])
-            self.assertEqual('', stdout.getvalue().strip())
-            self.assertEqual('', stderr.getvalue().strip())
-
-            # Assert the output state looks as we expect.
-            self.assertTrue(os.path.isfile(in_file))
-            self.assertTrue(os.path.isfile(out_file))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(in_dir))
-            undo_out_file = os.path.join(tempdir, 'file.txt')
-            backup.unarchive_path(tempdir, out_file)
-            self.assertTrue(os.path.isfile(undo_out_file))
-            self.assertEqual(in_file_hash, test.get_file_md5(undo_out_file))
-
-        finally:
-            shutil.rmtree(tempdir)
+        self._run_file_variant('file.txt.tar', backup.unarchive_path,
+                               archive='yes')
 
     def test_file_compress(self):
         """Basic test of a single file compress and backup."""
-        try:
-            # Setup the test state.
-            tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
-                'output')
-            in_file, out_file, cfg_file = self._create_single_file_test(\
-                'file.txt', 'file.txt.xz', tempdir, in_dir, out_dir, \
-                [_ConfigSection('input/file.txt', out_dir, compress='yes')])
-            in_dir_hash = test.get_dir_md5(in_dir)
-            in_file_hash = test.get_file_md5(in_file)
-
-            # Run backup.
-            with redir_stdstreams() as (stdout, stderr):
-                backup.main(['--config', cfg_file])
-            self.assertEqual('', stdout.getvalue().strip())
-            self.assertEqual('', stderr.getvalue().strip())
-
-            # Assert the output state looks as we expect.
-            self.assertTrue(os.path.isfile(in_file))
-            self.assertTrue(os.path.isfile(out_file))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(in_dir))
-            undo_out_file = os.path.join(tempdir, 'file.txt')
-            backup.uncompress_path(undo_out_file, out_file)
-            self.assertTrue(os.path.isfile(undo_out_file))
-            self.assertEqual(in_file_hash, test.get_file_md5(undo_out_file))
-
-        finally:
-            shutil.rmtree(tempdir)
+        def undo(undo_dir, out_file):
+            backup.uncompress_path(os.path.join(undo_dir, 'file.txt'), out_file)
+        self._run_file_variant('file.txt.xz', undo, compress='yes')
 
     def test_file_encrypt(self):
         """Basic test of a single file encrypt and backup."""
-        try:
-            # Setup the test state.
-            tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
-                'output')
-            in_file, out_file, cfg_file = self._create_single_file_test(\
-                'file.txt', 'file.txt.gpg', tempdir, in_dir, out_dir, \
-                [_ConfigSection('input/file.txt', out_dir, encrypt='yes')])
-            in_dir_hash = test.get_dir_md5(in_dir)
-            in_file_hash = test.get_file_md5(in_file)
-
-            # Run backup.
-            with redir_stdstreams() as (stdout, stderr):
-                backup.main(['--config', cfg_file, '--gpg-home', test.GPG_HOME])
-            self.assertEqual('', stdout.getvalue().strip())
-            self.assertEqual('', stderr.getvalue().strip())
-
-            # Assert the output state looks as we expect.
-            self.assertTrue(os.path.isfile(in_file))
-            self.assertTrue(os.path.isfile(out_file))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(in_dir))
-            undo_out_file = os.path.join(tempdir, 'file.txt')
-            backup.unencrypt_path(undo_out_file, out_file, homedir=test.GPG_HOME)
-            self.assertTrue(os.path.isfile(undo_out_file))
-            self.assertEqual(in_file_hash, test.get_file_md5(undo_out_file))
-
-        finally:
-            shutil.rmtree(tempdir)
+        def undo(undo_dir, out_file):
+            backup.unencrypt_path(os.path.join(undo_dir, 'file.txt'), out_file,
+                                  homedir=test.GPG_HOME,
+                                  passphrase_file=test.PASSPHRASE_FILE)
+        self._run_file_variant('file.txt.gpg', undo, encrypt='yes')
+
+    def test_file_encrypt_twice(self):
+        """Test backing up an encrypted file over its existing backup."""
+        def undo(undo_dir, out_file):
+            backup.unencrypt_path(os.path.join(undo_dir, 'file.txt'), out_file,
+                                  homedir=test.GPG_HOME,
+                                  passphrase_file=test.PASSPHRASE_FILE)
+        self._run_file_variant('file.txt.gpg', undo, runs=2, encrypt='yes')
 
     def test_file_full_pipeline(self):
         """Basic test of a single file archive, compress, encrypt and backup."""
-        try:
-            # Setup the test state.
-            tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
-                'output')
-            in_file, out_file, cfg_file = self._create_single_file_test(\
-                'file.txt', 'file.txt.tar.xz.gpg', tempdir, in_dir, out_dir, \
-                [_ConfigSection('input/file.txt', out_dir, archive='yes',
-                                compress='yes', encrypt='yes')])
-            in_dir_hash = test.get_dir_md5(in_dir)
-            in_file_hash = test.get_file_md5(in_file)
-
-            # Run backup.
-            with redir_stdstreams() as (stdout, stderr):
-                backup.main(['--config', cfg_file, '--gpg-home', test.GPG_HOME])
-            self.assertEqual('', stdout.getvalue().strip())
-            self.assertEqual('', stderr.getvalue().strip())
-
-            # Assert the output state looks as we expect.
-            self.assertTrue(os.path.isfile(in_file))
-            self.assertTrue(os.path.isfile(out_file))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(in_dir))
-            undo_out_file = os.path.join(tempdir, 'file.txt')
-            backup.unencrypt_path(os.path.join(tempdir, 'file.txt.tar.xz'),
-                                  out_file, homedir=test.GPG_HOME)
-            backup.uncompress_path(os.path.join(tempdir, 'file.txt.tar'),
-                                   os.path.join(tempdir, 'file.txt.tar.xz'))
-            backup.unarchive_path(tempdir, os.path.join(tempdir, 'file.txt.tar'))
-            self.assertTrue(os.path.isfile(undo_out_file))
-            self.assertEqual(in_file_hash, test.get_file_md5(undo_out_file))
-
-        finally:
-            shutil.rmtree(tempdir)
+        def undo(undo_dir, out_file):
+            test.unpipeline_path(undo_dir, out_file, homedir=test.GPG_HOME,
+                                 passphrase_file=test.PASSPHRASE_FILE)
+        self._run_file_variant('file.txt.tar.xz.gpg', undo, archive='yes',
+                               compress='yes', encrypt='yes')
 
     def test_dir(self):
         """Most basic test of a single directory backup."""
-        try:
-            # Setup the test state.
-            tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
-                'output')
-            in_struct, out_struct, cfg_file = self._create_single_dir_test(\
-                'struct', 'struct', tempdir, in_dir, out_dir, \
-                [_ConfigSection('input/struct', out_dir)])
-            in_dir_hash = test.get_dir_md5(in_dir)
-
-            # Run backup.
-            with redir_stdstreams() as (stdout, stderr):
-                backup.main(['--config', cfg_file])
-            self.assertEqual('', stdout.getvalue().strip())
-            self.assertEqual('', stderr.getvalue().strip())
-
-            # Assert the output state looks as we expect.
-            self.assertTrue(os.path.isdir(in_struct))
-            self.assertTrue(os.path.isdir(out_struct))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(in_dir))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(out_dir))
-
-        finally:
-            shutil.rmtree(tempdir)
+        self._run_dir_variant('struct')
 
     def test_dir_archive(self):
         """Basic test of a single directory archive and backup."""
-        try:
-            # Setup the test state.
-            tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
-                'output')
-            in_struct, out_struct, cfg_file = self._create_single_dir_test(\
-                'struct', 'struct.tar', tempdir, in_dir, tempdir, \
-                [_ConfigSection('input/struct', tempdir, archive='yes')])
-            in_dir_hash = test.get_dir_md5(in_dir)
-
-            # Run backup.
-            with redir_stdstreams() as (stdout, stderr):
-                backup.main(['--config', cfg_file])
-            self.assertEqual('', stdout.getvalue().strip())
-            self.assertEqual('', stderr.getvalue().strip())
-
-            # Assert the output state looks as we expect.
-            self.assertTrue(os.path.isdir(in_struct))
-            self.assertTrue(os.path.isfile(out_struct))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(in_dir))
-            undo_out_file = os.path.join(out_dir, 'struct')
-            backup.unarchive_path(out_dir, out_struct)
-            self.assertTrue(os.path.isdir(undo_out_file))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(out_dir))
-
-        finally:
-            shutil.rmtree(tempdir)
+        self._run_dir_variant('struct.tar', backup.unarchive_path,
+                              archive='yes')
 
     def test_dir_compress(self):
         """Basic test of a single directory archive, compress and backup."""
-        try:
-            # Setup the test state.
-            tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
-                'output')
-            in_struct, out_struct, cfg_file = self._create_single_dir_test(\
-                'struct', 'struct.tar.xz', tempdir, in_dir, tempdir, \
-                [_ConfigSection('input/struct', tempdir, archive='yes',
-                                compress='yes')])
-            in_dir_hash = test.get_dir_md5(in_dir)
-
-            # Run backup.
-            with redir_stdstreams() as (stdout, stderr):
-                backup.main(['--config', cfg_file])
-            self.assertEqual('', stdout.getvalue().strip())
-            self.assertEqual('', stderr.getvalue().strip())
-
-            # Assert the output state looks as we expect.
-            self.assertTrue(os.path.isdir(in_struct))
-            self.assertTrue(os.path.isfile(out_struct))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(in_dir))
-            undo_out_file = os.path.join(out_dir, 'struct')
-            backup.uncompress_path(os.path.join(tempdir, 'struct.tar'), out_struct)
-            backup.unarchive_path(out_dir, os.path.join(tempdir, 'struct.tar'))
-            self.assertTrue(os.path.isdir(undo_out_file))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(out_dir))
-
-        finally:
-            shutil.rmtree(tempdir)
+        self._run_dir_variant('struct.tar.xz', test.unpipeline_path,
+                              archive='yes', compress='yes')
 
     def test_dir_encrypt(self):
         """Basic test of a single directory archive, encrypt and backup."""
-        try:
-            # Setup the test state.
-            tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
-                'output')
-            in_struct, out_struct, cfg_file = self._create_single_dir_test(\
-                'struct', 'struct.tar.gpg', tempdir, in_dir, tempdir, \
-                [_ConfigSection('input/struct', tempdir, archive='yes',
-                                encrypt='yes')])
-            in_dir_hash = test.get_dir_md5(in_dir)
-
-            # Run backup.
-            with redir_stdstreams() as (stdout, stderr):
-                backup.main(['--config', cfg_file, '--gpg-home', test.GPG_HOME])
-            self.assertEqual('', stdout.getvalue().strip())
-            self.assertEqual('', stderr.getvalue().strip())
-
-            # Assert the output state looks as we expect.
-            self.assertTrue(os.path.isdir(in_struct))
-            self.assertTrue(os.path.isfile(out_struct))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(in_dir))
-            undo_out_file = os.path.join(out_dir, 'struct')
-            backup.unencrypt_path(os.path.join(tempdir, 'struct.tar'), out_struct,
-                                  homedir=test.GPG_HOME)
-            backup.unarchive_path(out_dir, os.path.join(tempdir, 'struct.tar'))
-            self.assertTrue(os.path.isdir(undo_out_file))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(out_dir))
-
-        finally:
-            shutil.rmtree(tempdir)
+        def undo(undo_dir, out_struct):
+            test.unpipeline_path(undo_dir, out_struct, homedir=test.GPG_HOME,
+                                 passphrase_file=test.PASSPHRASE_FILE)
+        self._run_dir_variant('struct.tar.gpg', undo, archive='yes',
+                              encrypt='yes')
 
     def test_dir_full_pipeline(self):
         """Basic test of a single directory archive, encrypt and backup."""
-        try:
-            # Setup the test state.
-            tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
-                'output')
-            in_struct, out_struct, cfg_file = self._create_single_dir_test(\
-                'struct', 'struct.tar.xz.gpg', tempdir, in_dir, tempdir, \
-                [_ConfigSection('input/struct', tempdir, archive='yes',
-                                compress='yes', encrypt='yes')])
-            in_dir_hash = test.get_dir_md5(in_dir)
-
-            # Run backup.
-            with redir_stdstreams() as (stdout, stderr):
-                backup.main(['--config', cfg_file, '--gpg-home', test.GPG_HOME])
-            self.assertEqual('', stdout.getvalue().strip())
-            self.assertEqual('', stderr.getvalue().strip())
-
-            # Assert the output state looks as we expect.
-            self.assertTrue(os.path.isdir(in_struct))
-            self.assertTrue(os.path.isfile(out_struct))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(in_dir))
-            undo_out_file = os.path.join(out_dir, 'struct')
-            backup.unencrypt_path(os.path.join(tempdir, 'struct.tar.xz'),
-                                  out_struct, homedir=test.GPG_HOME)
-            backup.uncompress_path(os.path.join(tempdir, 'struct.tar'),
-                                   os.path.join(tempdir, 'struct.tar.xz'))
-            backup.unarchive_path(out_dir, os.path.join(tempdir, 'struct.tar'))
-            self.assertTrue(os.path.isdir(undo_out_file))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(out_dir))
-
-        finally:
-            shutil.rmtree(tempdir)
+        def undo(undo_dir, out_struct):
+            test.unpipeline_path(undo_dir, out_struct, homedir=test.GPG_HOME,
+                                 passphrase_file=test.PASSPHRASE_FILE)
+        self._run_dir_variant('struct.tar.xz.gpg', undo, archive='yes',
+                              compress='yes', encrypt='yes')
 
     def test_dir_full_pipeline_verbose(self):
         """
         Basic test of a single directory archive, encrypt and backup while
         outputting verbose status, ensuring it does not change the result.
         """
-        try:
-            # Setup the test state.
-            tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
-                'output')
-            in_struct, out_struct, cfg_file = self._create_single_dir_test(\
-                'struct', 'struct.tar.xz.gpg', tempdir, in_dir, tempdir, \
-                [_ConfigSection('input/struct', tempdir, archive='yes',
-                                compress='yes', encrypt='yes')])
-            in_dir_hash = test.get_dir_md5(in_dir)
-
-            # Run backup.
-            with redir_stdstreams() as (stdout, stderr):
-                backup.main(['--config', cfg_file, '--gpg-home', test.GPG_HOME,
-                             '--verbose'])
-            stdout_str = stdout.getvalue().strip()
-            self.assertIn('archive_path', stdout_str)
-            self.assertIn('compress_path', stdout_str)
-            self.assertIn('encrypt_path', stdout_str)
-            self.assertIn('copy_path', stdout_str)
-            self.assertEqual('', stderr.getvalue().strip())
-
-            # Assert the output state looks as we expect.
-            self.assertTrue(os.path.isdir(in_struct))
-            self.assertTrue(os.path.isfile(out_struct))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(in_dir))
-            undo_out_file = os.path.join(out_dir, 'struct')
-            backup.unencrypt_path(os.path.join(tempdir, 'struct.tar.xz'),
-                                  out_struct, homedir=test.GPG_HOME)
-            backup.uncompress_path(os.path.join(tempdir, 'struct.tar'),
-                                   os.path.join(tempdir, 'struct.tar.xz'))
-            backup.unarchive_path(out_dir, os.path.join(tempdir, 'struct.tar'))
-            self.assertTrue(os.path.isdir(undo_out_file))
-            self.assertEqual(in_dir_hash, test.get_dir_md5(out_dir))
-
-        finally:
-            shutil.rmtree(tempdir)
+        # Setup the test state.
+        tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
+            'output')
+        in_struct, out_struct, cfg_file = self._create_single_dir_test(\
+            'struct', 'struct.tar.xz.gpg', tempdir, in_dir, tempdir, \
+            [_ConfigSection('input/struct', tempdir, archive='yes',
+                            compress='yes', encrypt='yes')])
+        in_dir_hash = _cached_dir_hash(in_dir)
+
+        # Run backup.
+        with redir_stdstreams() as (stdout, stderr):
+            backup.main(['--config', cfg_file, '--gpg-home', test.GPG_HOME,
+                         '--verbose'])
+        stdout_str = stdout.getvalue().strip()
+        self.assertIn('pipeline_path', stdout_str)
+        self.assertIn('struct/root_file.txt', stdout_str.split())
+        self.assertIn('struct/test_dir1/test_subdir/file.bin',
+                      stdout_str.split())
+        self.assertEqual('', stderr.getvalue().strip())
+
+        # Assert the output state looks as we expect.
+        self.assertTrue(os.path.isfile(out_struct))
+        self.assertEqual(in_dir_hash, _cached_dir_hash(in_dir))
+        test.unpipeline_path(out_dir, out_struct, homedir=test.GPG_HOME)
+        self.assertEqual(in_dir_hash, _cached_dir_hash(out_dir))
+
+    @test.run_serially
+    def test_multiple_sections_parallel(self):
+        """Basic test of archiving multiple sections in parallel."""
+        # Setup the test state.
+        tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
+            'output')
+        in_file, out_file, cfg_file = self._create_single_file_test(\
+            'file.txt', 'file.txt.tar', tempdir, in_dir, out_dir, \
+            [_ConfigSection('input/file.txt', out_dir, archive='yes'),
+             _ConfigSection('input/struct', out_dir, archive='yes')])
+        in_struct = os.path.join(in_dir, 'struct')
+        out_struct = os.path.join(out_dir, 'struct.tar')
+        test.clone_tree(self._canonical_struct, in_struct)
+        in_dir_hash = _cached_dir_hash(in_dir)
+        in_file_hash = _cached_file_hash(in_file)
+        in_struct_hash = _cached_dir_hash(in_struct)
+
+        # Run backup.
+        with redir_stdstreams() as (stdout, stderr):
+            backup.main(['--config', cfg_file, '--jobs', '2'])
+        self.assertEqual('', stdout.getvalue().strip())
+        self.assertEqual('', stderr.getvalue().strip())
+
+        # Assert the output state looks as we expect.
+        self.assertTrue(os.path.isfile(out_file))
+        self.assertTrue(os.path.isfile(out_struct))
+        self.assertEqual(in_dir_hash, _cached_dir_hash(in_dir))
+        undo_dir = os.path.join(tempdir, 'undo')
+        os.makedirs(undo_dir)
+        backup.unarchive_path(undo_dir, out_file)
+        backup.unarchive_path(undo_dir, out_struct)
+        self.assertEqual(in_file_hash,
+                         _cached_file_hash(os.path.join(undo_dir, 'file.txt')))
+        self.assertEqual(in_struct_hash,
+                         _cached_dir_hash(os.path.join(undo_dir, 'struct')))
+
+    @test.run_serially
+    def test_multiple_sections_parallel_verbose(self):
+        """Test each parallel section's verbose output reaches sys.stdout."""
+        # Setup the test state.
+        tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
+            'output')
+        _, out_file, cfg_file = self._create_single_file_test(\
+            'file.txt', 'file.txt.tar', tempdir, in_dir, out_dir, \
+            [_ConfigSection('input/file.txt', out_dir, archive='yes'),
+             _ConfigSection('input/struct', out_dir, archive='yes')])
+        out_struct = os.path.join(out_dir, 'struct.tar')
+        test.clone_tree(self._canonical_struct, os.path.join(in_dir, 'struct'))
+
+        # Run backup.
+        with redir_stdstreams() as (stdout, _):
+            backup.main(['--config', cfg_file, '--jobs', '2', '--verbose'])
+
+        # Assert each section's output was written whole, in section order.
+        output = stdout.getvalue()
+        file_start = output.find('archive_path(%s, ' % (out_file))
+        struct_start = output.find('archive_path(%s, ' % (out_struct))
+        self.assertNotEqual(-1, file_start)
+        self.assertLess(file_start, struct_start)
+        self.assertNotIn('struct/', output[:struct_start])
+
+    @test.run_serially
+    def test_multiple_sections_parallel_error(self):
+        """
+        Test a failing parallel section's error is raised only after every
+        section's output has been written.
+        """
+        # Setup the test state.
+        tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
+            'output')
+        _, out_file, cfg_file = self._create_single_file_test(\
+            'file.txt', 'file.txt.tar', tempdir, in_dir, out_dir, \
+            [_ConfigSection('input/no_such_file.txt', out_dir, archive='yes'),
+             _ConfigSection('input/file.txt', out_dir, archive='yes')])
+
+        # Run backup.
+        with redir_stdstreams() as (stdout, _):
+            self.assertRaises(OSError, backup.main,
+                              ['--config', cfg_file, '--jobs', '2',
+                               '--verbose'])
+
+        # Assert the successful section was still processed and output.
+        self.assertTrue(os.path.isfile(out_file))
+        self.assertIn('archive_path(%s, ' % (out_file), stdout.getvalue())
+
+    def test_dir_incremental(self):
+        """Basic test of incrementally archiving a directory twice."""
+        # Setup the test state.
+        tempdir, in_dir, out_dir = self._create_tempdir_structure('input', \
+            'output')
+        in_struct, _, cfg_file = self._create_single_dir_test(\
+            'struct', 'struct.tar', tempdir, in_dir, out_dir, \
+            [_ConfigSection('input/struct', out_dir, archive='yes',
+                            incremental='yes')])
+        out_snapshot = os.path.join(out_dir, 'struct.snar')
+
+        # Run backup twice, changing a single file in between. The runs are
+        # (usually) within the same second, so must not share an archive name.
+        with redir_stdstreams() as (stdout, stderr):
+            backup.main(['--config', cfg_file])
+        self.assertEqual('', stdout.getvalue().strip())
+        self.assertEqual('', stderr.getvalue().strip())
+        self.assertTrue(os.path.isfile(out_snapshot))
+        changed_file = os.path.join(in_struct, 'root_file.txt')
+        os.remove(changed_file)
+        test.create_ascii_file(changed_file, 32)
+        with redir_stdstreams() as (stdout, stderr):
+            backup.main(['--config', cfg_file])
+        self.assertEqual('', stdout.getvalue().strip())
+        self.assertEqual('', stderr.getvalue().strip())
+
+        # Assert the output state looks as we expect.
+        out_files = sorted(glob.glob(os.path.join(out_dir, 'struct.*.tar')))
+        self.assertEqual(2, len(out_files))
+        self.assertFalse(os.path.exists(out_snapshot + '.tmp'))
+        full_list = subprocess.check_output(['tar', '--list', '--file',
+                                             out_files[0]],
+                                            universal_newlines=True)
+        incr_list = subprocess.check_output(['tar', '--list', '--file',
+                                             out_files[1]],
+                                            universal_newlines=True)
+        self.assertIn('struct/test_dir1/file.bin', full_list.split())
+        self.assertIn('struct/root_file.txt', incr_list.split())
+        self.assertNotIn('struct/test_dir1/file.bin', incr_list.split())
 
     def test_nonexistant_config_error(self):
         """Test that providing a non-existant config file raises an error."""
         self.assertRaises(OSError, backup.main, ['--config', '/no/such/file.txt'])
 
+    @unittest.skipIf(os.geteuid() == 0, 'root can read any file')
+    def test_unreadable_config_error(self):
+        """Test that providing an unreadable config file raises an error."""
+        cfg_file = os.path.join(self._create_tempdir(), 'unreadable.cfg')
+        _write_config_file(cfg_file, [_ConfigSection(self._root, self._root)])
+        os.chmod(cfg_file, 0)
+        self.assertRaises(IOError, backup.main, ['--config', cfg_file])
+
     def test_invalid_config_error(self):
         """Test that providing an invalid config file raises an error."""
-        try:
-            tempdir = tempfile.mkdtemp()
-            cfg_file = os.path.join(tempdir, 'invalid.cfg')
-            _write_config_file(cfg_file, [_ConfigSection('/no/such/file.txt',
-                                                         tempdir)])
-            self.assertRaises(OSError, backup.main, ['--config', cfg_file])
-
-        finally:
-            shutil.rmtree(tempdir)
+        # backup rejects the config before running any commands, so the
+        # config needs no test directory of its own.
+        cfg_file = os.path.join(self._root, 'invalid_config.cfg')
+        _write_config_file(cfg_file, [_ConfigSection('/no/such/file.txt',
+                                                     self._root)])
+        self.assertRaises(OSError, backup.main, ['--config', cfg_file])
+
+    def test_invalid_compressor_error(self):
+        """Test that providing an unsupported compressor raises an error."""
+        cfg_file = os.path.join(self._root, 'invalid_compressor.cfg')
+        _write_config_file(cfg_file, [_ConfigSection(self._root, self._root,
+                                                     compress='yes',
+                                                     compressor='gzip')])
+        self.assertRaises(ValueError, backup.main, ['--config', cfg_file])
 
@@ -26,16 +26,93 @@ Main test runner for tiny-backup.
 
 Maintained at https://github.com/jonsim/tiny-backup
 """
+from __future__ import print_function
+import collections
+import filecmp
+import functools
+import hashlib
+import itertools
+import mmap
+import multiprocessing
+import multiprocessing.pool # ThreadPool
+import multiprocessing.util # Finalize
 import os.path
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
 import unittest
+try:
+    import xxhash   # Optional, much faster than md5 where available.
+except ImportError:
+    xxhash = None
+try:
+    import magic    # Optional, classifies files in-process rather than forking.
+except ImportError:
+    magic = None
+try:
+    from shutil import which # Python 3
+except ImportError:
+    from distutils.spawn import find_executable as which # Python 2
+# To avoid having to make the parent directory a module just amend PYTHONPATH
+# (once, as the test modules also do so).
+_PARENT_DIR = os.path.join(sys.path[0], '..')
+if _PARENT_DIR not in sys.path:
+    sys.path.insert(1, _PARENT_DIR)
+import backup
 
 #
 # Shared testing defines.
 #
 
 GPG_HOME = os.path.join(sys.path[0], 'gpg-test-homedir')
+# Symmetric encryption (with this completely insecure passphrase) skips GPG's
+# public key operations, so is used by the tests which don't need the key.
+PASSPHRASE_FILE = os.path.join(sys.path[0], 'gpg-test-passphrase.txt')
+# When md5 is the hash in use, files at least this large are hashed by the
+# md5sum tool (if available), which outruns Python's read loop by enough to
+# repay its process startup.
+MD5SUM_MIN_SIZE = 64 << 20
+# Files larger than this are hashed straight from a memory mapping, which saves
+# copying them through a read buffer. Smaller files are read in a single raw
+# read, bypassing the buffered file object.
+MMAP_MIN_SIZE = 4 << 10
+# The most processes run_parallel uses by default. Each test runs several
+# pipelined tools, so many more workers would only contend for file descriptors
+# and IO rather than finish sooner.
+MAX_DEFAULT_JOBS = 8
+# Temporary test directories are created in RAM (tmpfs) where possible, since
+# the tests are dominated by writing and reading back many small files.
+TMP_ROOT = ('/dev/shm' if os.path.isdir('/dev/shm') and
+            os.access('/dev/shm', os.W_OK) else None)
+# Encodes a path to bytes for hashing (Python 2 paths are already bytes).
+_fsencode = getattr(os, 'fsencode', lambda path: path)
+# Every byte value once, repeated to form binary files.
+_BIN_PATTERN = bytes(bytearray(range(256)))
+_MAGIC = magic.Magic() if magic else None
+
+def _pick_hash():
+    """
+    Picks the hash to compare file contents with. The hashes are only used to
+    check test data for equality, so a fast non-cryptographic hash is preferred.
+    Otherwise blake2b (Python >= 3.6, trimmed to md5's length) is used, as it
+    outruns md5 on most CPUs, falling back to md5.
+
+    Returns:
+        callable returning a new hash object, optionally given initial data.
+    """
+    if xxhash:
+        return xxhash.xxh3_128
+    if hasattr(hashlib, 'blake2b'):
+        return functools.partial(hashlib.blake2b, digest_size=16)
+    return hashlib.md5
+
+# Creates hash objects for comparing file contents.
+_new_hash = _pick_hash()
+# The length of the hex digests returned by get_file_hash and get_dir_hash.
+HASH_HEX_LENGTH = len(_new_hash().hexdigest())
+MD5SUM = which('md5sum') if _new_hash is hashlib.md5 else None
 
 
 
@@ -43,6 +120,61 @@ GPG_HOME = os.path.join(sys.path[0], 'gpg-test-homedir')
 # Shared testing methods.
 #
 
+# Maps the size, in KB, of each ASCII file's contents formed to the contents.
+# Each line of an ASCII file holds 16 four digit numbers, so is 80 characters.
+_ASCII_LINE = ' '.join(['%04d'] * 16) + '\n'
+_ascii_contents_cache = {}
+
+def _ascii_contents(kb_size):
+    """
+    Forms the contents of an ASCII file. The contents of each size are only
+    formed once.
+
+    Args:
+        kb_size:    int (approximate) size, in KB, of the contents to form.
+
+    Returns:
+        bytes contents.
+    """
+    if kb_size not in _ascii_contents_cache:
+        num_lines = -(-kb_size * 1024 // 80)
+        _ascii_contents_cache[kb_size] = ''.join(
+            [_ASCII_LINE % tuple(range(i, i + 16))
+             for i in range(0, num_lines * 16, 16)]).encode('ascii')
+    return _ascii_contents_cache[kb_size]
+
+def _binary_contents(kb_size):
+    """
+    Forms the contents of a binary file.
+
+    Args:
+        kb_size:    int (approximate) size, in KB, of the contents to form.
+
+    Returns:
+        bytes contents.
+    """
+    return _BIN_PATTERN * (4 * kb_size)
+
+def _write_new_file(path, contents):
+    """
+    Writes a new file, failing if anything already exists at the path.
+
+    Args:
+        path:       string path for the file to be written to.
+        contents:   bytes contents to write.
+
+    Raises:
+        OSError:    if the path already exists.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                 getattr(os, 'O_CLOEXEC', 0), 0o666)
+    try:
+        view = memoryview(contents)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
 def create_ascii_file(path, kb_size=16):
     """
     Creates an ASCII file.
@@ -51,15 +183,7 @@ def create_ascii_file(path, kb_size=16):
         path:       string path for the file to be written to.
         kb_size:    int (approximate) size, in KB, of the file to create.
     """
-    assert not os.path.exists(path)
-    with open(path, 'w') as out_file:
-        num = 0
-        file_size = 0
-        while (file_size / 1024) < kb_size:
-            line = ' '.join(["%04d" % (i) for i in range(num * 16, (num + 1) * 16)]) + '\n'
-            out_file.write(line)
-            num += 1
-            file_size += len(line)
+    _write_new_file(path, _ascii_contents(kb_size))
 
 def create_binary_file(path, kb_size=16):
     """
@@ -69,9 +193,37 @@ def create_binary_file(path, kb_size=16):
         path:       string path for the file to be written to.
         kb_size:    int (approximate) size, in KB, of the file to create.
     """
-    assert not os.path.exists(path)
-    with open(path, 'wb') as out_file:
-        out_file.write(bytearray(range(256) * 4 * kb_size))
+    _write_new_file(path, _binary_contents(kb_size))
+
+# The files making up a test directory as (name, contents function, KB size).
+_TEST_DIR_FILES = [
+    ('file.txt', _ascii_contents, 8),
+    ('file.log', _ascii_contents, 24),
+    ('file.bin', _binary_contents, 16),
+]
+
+def _create_files(path, plan):
+    """
+    Creates a directory and populates it with files. Each distinct file's
+    contents are only formed once.
+
+    Args:
+        path:       string path for the directory to be created at. Must not
+            already exist.
+        plan:       list of (string relative path, contents function, int KB
+            size) tuples describing the files to create.
+    """
+    os.makedirs(path)
+    dirs = sorted(set(os.path.dirname(rel_path) for rel_path, _, _ in plan))
+    for directory in dirs:
+        if directory:
+            os.makedirs(os.path.join(path, directory))
+    contents = {}
+    for rel_path, contents_func, kb_size in plan:
+        if (contents_func, kb_size) not in contents:
+            contents[(contents_func, kb_size)] = contents_func(kb_size)
+        _write_new_file(os.path.join(path, rel_path),
+                        contents[(contents_func, kb_size)])
 
 def create_test_dir(path):
     """
@@ -80,11 +232,7 @@ def create_test_dir(path):
     Args:
         path:       string path for the directory to be created at.
     """
-    assert not os.path.exists(path)
-    os.makedirs(path)
-    create_ascii_file(os.path.join(path, 'file.txt'), 8)
-    create_ascii_file(os.path.join(path, 'file.log'), 24)
-    create_binary_file(os.path.join(path, 'file.bin'), 16)
+    _create_files(path, _TEST_DIR_FILES)
 
 def create_test_structure(path):
     """
@@ -93,65 +241,321 @@ def create_test_structure(path):
     Args:
         path:       string path for the directory structure to be created at.
     """
-    assert not os.path.exists(path)
-    os.makedirs(path)
-    create_test_dir(os.path.join(path, 'test_dir1'))
-    create_test_dir(os.path.join(path, 'test_dir1', 'test_subdir'))
-    create_test_dir(os.path.join(path, 'test_dir2'))
-    create_ascii_file(os.path.join(path, 'root_file.txt'))
-    create_binary_file(os.path.join(path, 'root_file.bin'))
+    dirs = ['test_dir1', os.path.join('test_dir1', 'test_subdir'), 'test_dir2']
+    plan = [(os.path.join(directory, name), contents_func, kb_size)
+            for directory in dirs
+            for name, contents_func, kb_size in _TEST_DIR_FILES]
+    plan.append(('root_file.txt', _ascii_contents, 16))
+    plan.append(('root_file.bin', _binary_contents, 16))
+    _create_files(path, plan)
 
-def get_file_md5(path):
+def get_file_hash(path):
     """
-    Retrieves the md5sum of a file's contents.
+    Retrieves the hash of a file's contents.
 
     Args:
         path:   string path of the file to hash.
 
     Returns:
-        string md5sum hash.
+        string hex digest.
+    """
+    size = os.path.getsize(path)
+    if MD5SUM and size >= MD5SUM_MIN_SIZE:
+        return subprocess.check_output([MD5SUM, path],
+                                       universal_newlines=True).split()[0]
+    hash_obj = _new_hash()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if size > MMAP_MIN_SIZE:
+            mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            try:
+                if hasattr(mapping, 'madvise'):
+                    mapping.madvise(mmap.MADV_SEQUENTIAL)
+                hash_obj.update(mapping)
+            finally:
+                mapping.close()
+        else:
+            hash_obj.update(os.read(fd, size))
+    finally:
+        os.close(fd)
+    return hash_obj.hexdigest()
+
+def walk_dir(top):
+    """
+    Walks a directory tree top-down in sorted order, in the manner of os.walk.
+    Uses os.scandir where available (Python >= 3.5) so each entry's type comes
+    from the cached directory entry rather than a further stat call.
+
+    Args:
+        top:    string path of the directory to walk.
+
+    Yields:
+        string path of each directory in the tree.
+        list of string names of its subdirectories, sorted.
+        list of string paths of its other entries, sorted by name.
     """
-    import hashlib
-    hash_md5 = hashlib.md5()
-    with open(path, 'rb') as in_file:
-        hash_md5.update(in_file.read())
-    return hash_md5.hexdigest()
+    if not hasattr(os, 'scandir'):
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            files.sort()
+            yield root, dirs, [os.path.join(root, name) for name in files]
+        return
+    stack = [top]
+    while stack:
+        root = stack.pop()
+        dirs, files = [], []
+        for entry in os.scandir(root):
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry)
+            else:
+                files.append(entry)
+        dirs.sort(key=lambda entry: entry.name)
+        files.sort(key=lambda entry: entry.name)
+        yield (root, [entry.name for entry in dirs],
+               [entry.path for entry in files])
+        stack.extend(entry.path for entry in reversed(dirs))
 
-def get_dir_md5(path):
+def get_dir_hash(path):
     """
-    Retrieves the md5sum for a directory and all its contents.
+    Retrieves the hash for a directory and all its contents.
 
     Args:
         path:   string path of the directory to hash.
 
     Returns:
-        string md5sum hash.
+        string hex digest.
     """
-    import hashlib
-    hash_md5 = hashlib.md5()
-    for root, dirs, files in os.walk(path):
-        dirs.sort()
-        files.sort()
+    metas, files = [], []
+    for root, dirs, dir_files in walk_dir(path):
         rel_root = '.' + root[len(path):]
-        hash_md5.update(rel_root)
-        for directory in dirs:
-            hash_md5.update(directory)
-        for sub_file in files:
-            with open(os.path.join(root, sub_file), 'rb') as in_file:
-                hash_md5.update(in_file.read())
-    return hash_md5.hexdigest()
+        metas.append((b'\0'.join([_fsencode(name)
+                                  for name in [rel_root] + dirs]) + b'\0',
+                      len(dir_files)))
+        files.extend(dir_files)
+
+    # Hash the files concurrently (hashlib releases the GIL while hashing) and
+    # then combine their digests with the directory names in walk order.
+    if len(files) > 1:
+        pool = multiprocessing.pool.ThreadPool(min(len(files),
+                                                   multiprocessing.cpu_count()))
+        try:
+            digests = pool.map(get_file_hash, files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        digests = [get_file_hash(sub_file) for sub_file in files]
+    hash_obj = _new_hash()
+    digests = iter(digests)
+    for meta, num_files in metas:
+        hash_obj.update(meta)
+        for _ in range(num_files):
+            hash_obj.update(next(digests).encode('ascii'))
+    return hash_obj.hexdigest()
+
+def clone_tree(src, dest):
+    """
+    Recreates a directory tree with each file hardlinked to the original, so
+    no file contents are copied. The clone must not be modified in place.
+
+    Args:
+        src:    string path of the directory tree to clone.
+        dest:   string path to create the clone at. Must not already exist.
+    """
+    os.mkdir(dest)
+    if hasattr(os, 'scandir'):
+        entries = [(entry.name, entry.is_dir(follow_symlinks=False))
+                   for entry in os.scandir(src)]
+    else:
+        entries = [(name, os.path.isdir(os.path.join(src, name)))
+                   for name in os.listdir(src)]
+    for name, is_dir in entries:
+        if is_dir:
+            clone_tree(os.path.join(src, name), os.path.join(dest, name))
+        else:
+            os.link(os.path.join(src, name), os.path.join(dest, name))
+
+def files_equal(path_a, path_b):
+    """
+    Compares the contents of two files byte-by-byte. This makes a single pass
+    over each file, so is cheaper than comparing their hashes.
+
+    Args:
+        path_a: string path of the first file to compare.
+        path_b: string path of the second file to compare.
+
+    Returns:
+        boolean, True if the files' contents are identical.
+    """
+    return filecmp.cmp(path_a, path_b, shallow=False)
+
+def unpipeline_path(dest, src, homedir=None, passphrase_file=None):
+    """
+    Reverses an archive pipeline (optionally compressed and/or encrypted) in a
+    single pass by streaming the output of gpg and xz, as needed, into tar,
+    without writing any intermediate files. The stages to reverse are taken
+    from src's extensions.
+
+    Args:
+        dest:       string path for the directory to extract into.
+        src:        string path for the .tar, .tar.xz, .tar.gpg or .tar.xz.gpg
+            file to restore from.
+        homedir:    string path for the location of the GPG home directory to
+            use. May be None to use the default. Defaults to None.
+        passphrase_file: string path for a file containing the passphrase src
+            was symmetrically encrypted with. May be None if it was encrypted
+            for the default key. Defaults to None.
+
+    Raises:
+        CalledProcessError: if any command in the pipeline fails.
+    """
+    assert src.endswith(('.tar', '.tar.xz', '.tar.gpg', '.tar.xz.gpg'))
+    cmds = []
+    if src.endswith('.gpg'):
+        # Decrypt with the same gpg arguments backup uses, so the two agree on
+        # e.g. how a passphrase file is given to each GPG version.
+        cmds.append(backup.gpg_cmd(homedir=homedir,
+                                   passphrase_file=passphrase_file) +
+                    ['--decrypt', src])
+    if src.endswith(('.xz', '.xz.gpg')):
+        xz_cmd = ['xz', '--quiet', '--decompress', '--stdout']
+        cmds.append(xz_cmd if cmds else xz_cmd + [src])
+    cmds.append(['tar', '--extract', '--directory', dest, '--file',
+                 '-' if cmds else src])
+    procs = []
+    stdin = None
+    for cmd in cmds:
+        stdout = None if cmd is cmds[-1] else subprocess.PIPE
+        procs.append(subprocess.Popen(cmd, stdin=stdin, stdout=stdout))
+        if stdin:
+            stdin.close()
+        stdin = procs[-1].stdout
+    returncodes = [proc.wait() for proc in reversed(procs)]
+    for cmd, returncode in zip(reversed(cmds), returncodes):
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+def isolate_gpg_home(parent):
+    """
+    Copies the GPG home directory into a directory and uses the copy as
+    GPG_HOME from then on, so that gpg invocations from concurrent test
+    processes do not contend for the locks (or agent) of a shared home.
+
+    Args:
+        parent: string path to the directory to create the copy within.
+    """
+    global GPG_HOME
+    gpg_home = os.path.join(parent, 'gpg')
+    shutil.copytree(GPG_HOME, gpg_home, ignore=shutil.ignore_patterns('S.*'))
+    os.chmod(gpg_home, 0o700)
+    GPG_HOME = gpg_home
+
+def start_gpg_agent():
+    """
+    Starts a single gpg-agent for GPG_HOME (for GPG implementations which use
+    one) for the encryption tests to share, rather than the first gpg
+    invocation in each test paying for (or racing to) start one.
+    """
+    if which('gpg-connect-agent'):
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.call(['gpg-connect-agent', '--homedir', GPG_HOME,
+                             '/bye'], stdout=devnull, stderr=devnull)
+
+def stop_gpg_agent():
+    """Stops any gpg-agent running for GPG_HOME."""
+    if which('gpgconf'):
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.call(['gpgconf', '--homedir', GPG_HOME,
+                             '--kill', 'gpg-agent'],
+                            stdout=devnull, stderr=devnull)
+
+# Maps the ID of each process to its persistent 'file' process, if it has one.
+_file_procs = {}
+
+def _file_process():
+    """
+    Retrieves this process's persistent 'file' process, starting it on first
+    use. It reads paths from its stdin, one per line, and writes each one's file
+    type to its stdout as soon as it is determined. It is closed and waited for
+    when this process exits.
+
+    Returns:
+        subprocess.Popen of the 'file' process.
+    """
+    pid = os.getpid()
+    if pid not in _file_procs:
+        _file_procs[pid] = subprocess.Popen(['file', '--brief', '--no-buffer',
+                                             '--files-from', '-'],
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            universal_newlines=True)
+        # Finalizers with an exitpriority run on exit of both the main process
+        # and multiprocessing workers (which skip atexit), after those of
+        # higher priority, such as _finish_test_worker.
+        multiprocessing.util.Finalize(None, _close_file_process,
+                                      args=(_file_procs[pid],), exitpriority=0)
+    return _file_procs[pid]
+
+def _close_file_process(proc):
+    """
+    Closes a persistent 'file' process started by _file_process, by closing its
+    stdin, and waits for it to exit.
+
+    Args:
+        proc:   subprocess.Popen of the 'file' process.
+    """
+    proc.stdin.close()
+    proc.wait()
+    proc.stdout.close()
+
+def stat_signature(path):
+    """
+    Forms a signature of a path's metadata which changes whenever its contents
+    do (or, for hardlinks and copies made with metadata, not at all).
+
+    Args:
+        path:   string path to form the signature for.
+
+    Returns:
+        tuple signature.
+    """
+    path_stat = os.lstat(path)
+    return (path_stat.st_dev, path_stat.st_ino, path_stat.st_size,
+            getattr(path_stat, 'st_mtime_ns', path_stat.st_mtime))
+
+# Maps each path classified by get_file_type to its stat_signature and file
+# type when it was classified.
+_file_type_cache = {}
 
 def get_file_type(path):
     """
-    Determines the file type of a path as given by the 'file' command.
+    Determines the file type of a path as given by the 'file' command. If the
+    python-magic module is installed the same libmagic classification is made
+    in-process instead. Otherwise a single 'file' process is kept running to
+    classify every path, rather than starting one per path. A path is only
+    reclassified if it has changed since it was last classified.
 
     Args:
-        path:   string path of the file whose type will be determined.
+        path:   string path of the file whose type will be determined. Must not
+            contain a newline.
 
     Returns:
         string file type.
     """
-    return subprocess.check_output(['file', '--brief', path]).strip()
+    assert '\n' not in path
+    signature = stat_signature(path)
+    cached = _file_type_cache.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    if _MAGIC:
+        file_type = _MAGIC.from_file(path)
+    else:
+        proc = _file_process()
+        proc.stdin.write(path + '\n')
+        proc.stdin.flush()
+        file_type = proc.stdout.readline().strip()
+    _file_type_cache[path] = (signature, file_type)
+    return file_type
 
 
 
@@ -159,26 +563,206 @@ def get_file_type(path):
 # Main test runner.
 #
 
+def run_serially(test_method):
+    """
+    Marks a test method for run_parallel to run in the main process rather than
+    a pool worker, for tests which start processes of their own (e.g. through
+    backup's use of multiprocessing).
+
+    Args:
+        test_method:    test method function to mark.
+
+    Returns:
+        test_method, marked.
+    """
+    test_method.run_serially = True
+    return test_method
+
+# The TestCase class run by each parallel test worker process.
+_worker_test_case = None
+# The test outcomes run_parallel counts, and their names in its summary.
+_OUTCOME_COUNTS = collections.OrderedDict([
+    ('FAIL', 'failures'),
+    ('ERROR', 'errors'),
+    ('skipped', 'skipped'),
+    ('expected failure', 'expected failures'),
+    ('unexpected success', 'unexpected successes')])
+
+def _init_test_worker(test_case):
+    """
+    Initialises a worker process for run_parallel. Each worker sets up the
+    TestCase's class fixtures once, and uses its own copy of the GPG home
+    directory so concurrent gpg invocations do not contend for its locks.
+
+    Args:
+        test_case:  unittest.TestCase subclass the worker will run tests from.
+    """
+    global _worker_test_case
+    # The test modules see this file as the 'test' module, which need not be
+    # the module this is running in (e.g. if this file is __main__).
+    import test as shared
+    tempdir = tempfile.mkdtemp(prefix='tb-%d-' % (os.getpid()),
+                               dir=shared.TMP_ROOT)
+    shared.isolate_gpg_home(tempdir)
+    test_case.setUpClass()
+    _worker_test_case = test_case
+    multiprocessing.util.Finalize(None, _finish_test_worker,
+                                  args=(test_case, tempdir), exitpriority=10)
+
+def _finish_test_worker(test_case, tempdir):
+    """
+    Tears down a worker process initialised by _init_test_worker.
+
+    Args:
+        test_case:  unittest.TestCase subclass the worker ran tests from.
+        tempdir:    string path to the worker's temporary directory.
+    """
+    test_case.tearDownClass()
+    shutil.rmtree(tempdir)
+
+def _run_tests_serially(test_case, method_names):
+    """
+    Runs tests one at a time in this process, with the class fixtures and GPG
+    home directory set up as _init_test_worker sets them up for a worker.
+
+    Args:
+        test_case:      unittest.TestCase subclass to run the tests of.
+        method_names:   list of string names of the test methods to run.
+
+    Yields:
+        the results of _run_test_worker for each test, in order.
+    """
+    global _worker_test_case
+    import test as shared
+    gpg_home = shared.GPG_HOME
+    tempdir = tempfile.mkdtemp(prefix='tb-%d-' % (os.getpid()),
+                               dir=shared.TMP_ROOT)
+    try:
+        shared.isolate_gpg_home(tempdir)
+        test_case.setUpClass()
+        _worker_test_case = test_case
+        try:
+            for method_name in method_names:
+                yield _run_test_worker(method_name)
+        finally:
+            test_case.tearDownClass()
+    finally:
+        shared.GPG_HOME = gpg_home
+        shutil.rmtree(tempdir)
+
+def _run_test_worker(method_name):
+    """
+    Runs a single test in a worker process initialised by _init_test_worker.
+
+    Args:
+        method_name:    string name of the test method to run.
+
+    Returns:
+        string test description.
+        string outcome, one of 'ok', 'FAIL', 'ERROR', 'skipped',
+            'expected failure' and 'unexpected success'.
+        string reason the test was skipped, or None if it was not.
+        list of string formatted tracebacks.
+    """
+    case = _worker_test_case(method_name)
+    result = unittest.TestResult()
+    case.run(result)
+    tracebacks = [traceback for _, traceback in result.errors + result.failures]
+    reason = None
+    if result.errors:
+        outcome = 'ERROR'
+    elif result.failures:
+        outcome = 'FAIL'
+    elif result.unexpectedSuccesses:
+        outcome = 'unexpected success'
+    elif result.expectedFailures:
+        outcome = 'expected failure'
+    elif result.skipped:
+        outcome = 'skipped'
+        reason = result.skipped[0][1]
+    else:
+        outcome = 'ok'
+    return str(case), outcome, reason, tracebacks
+
+def run_parallel(test_case, jobs=None):
+    """
+    Runs every test in a TestCase in parallel across a pool of processes. The
+    tests must be independent of one another. Tests marked by run_serially are
+    run one at a time in this process afterwards, since the pool's daemonic
+    workers may not start processes of their own.
+
+    Args:
+        test_case:  unittest.TestCase subclass to run the tests of.
+        jobs:       int number of processes to run tests in. May be None to use
+            one per core, up to MAX_DEFAULT_JOBS. Defaults to None.
+
+    Returns:
+        boolean, True if all tests passed.
+    """
+    method_names = unittest.defaultTestLoader.getTestCaseNames(test_case)
+    serial_names = [name for name in method_names
+                    if getattr(getattr(test_case, name), 'run_serially', False)]
+    parallel_names = [name for name in method_names
+                      if name not in serial_names]
+    if jobs is None:
+        jobs = min(multiprocessing.cpu_count(), MAX_DEFAULT_JOBS)
+    jobs = max(1, min(jobs, len(parallel_names)))
+    start_time = time.time()
+    pool = multiprocessing.Pool(jobs, _init_test_worker, (test_case,))
+    results = pool.imap(_run_test_worker, parallel_names)
+    if serial_names:
+        results = itertools.chain(results,
+                                  _run_tests_serially(test_case, serial_names))
+    counts = dict.fromkeys(_OUTCOME_COUNTS, 0)
+    reports = []
+    try:
+        for description, outcome, reason, tracebacks in results:
+            if reason is None:
+                print('%s ... %s' % (description, outcome))
+            else:
+                print('%s ... %s %r' % (description, outcome, reason))
+            if outcome in counts:
+                counts[outcome] += 1
+            if tracebacks:
+                reports.append((outcome, description, tracebacks))
+    finally:
+        pool.close()
+        pool.join()
+    for outcome, description, tracebacks in reports:
+        for traceback in tracebacks:
+            print('\n' + '=' * 70)
+            print('%s: %s' % (outcome, description))
+            print('-' * 70)
+            print(traceback)
+    print('-' * 70)
+    print('Ran %d tests in %.3fs\n' % (len(method_names),
+                                       time.time() - start_time))
+    # Summarise the outcomes as unittest's TextTestRunner does, counting an
+    # unexpected success as a failure.
+    infos = ['%s=%d' % (name, counts[outcome])
+             for outcome, name in _OUTCOME_COUNTS.items() if counts[outcome]]
+    passed = not (counts['FAIL'] or counts['ERROR'] or
+                  counts['unexpected success'])
+    print(('OK' if passed else 'FAILED') +
+          (' (%s)' % (', '.join(infos)) if infos else ''))
+    return passed
+
 def main():
     """Run all test suites."""
     # Life is too short to try to make Python's uniquely terrible package system
     # accept this as a nice package import.
-    from unittests import TestBackupMethods
+    from unittests import TestBackupMethods, TestBackupPureFunctions
     from systemtests import TestBackupSystem
-    # Load the tests.
-    runner = unittest.TextTestRunner(descriptions=False, verbosity=2)
-    ut_suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestBackupMethods)
-    st_suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestBackupSystem)
-    # Run the unit tests.
-    print 'Running unit tests...\n'
-    ut_res = runner.run(ut_suite)
-    if not ut_res.wasSuccessful():
+    # The tests are independent and mostly wait on external tools, so run them
+    # in parallel.
+    print('Running unit tests...\n')
+    if not (run_parallel(TestBackupPureFunctions) and
+            run_parallel(TestBackupMethods)):
         sys.exit(1)
-    print '\n\nRunning system tests...\n'
-    st_res = runner.run(st_suite)
-    if not st_res.wasSuccessful():
+    print('\n\nRunning system tests...\n')
+    if not run_parallel(TestBackupSystem):
         sys.exit(1)
-    print '\n\nAll tests passed.'
+    print('\n\nAll tests passed.')
     sys.exit(0)
 
 # Entry point.
@@ -26,13 +26,17 @@ Unit tests for tiny-backup.
 
 Maintained at https://github.com/jonsim/tiny-backup
 """
+import multiprocessing.pool # ThreadPool
 import os
 import shutil
 import sys
 import tempfile
 import unittest
-# To avoid having to make the parent directory a module just amend PYTHONPATH.
-sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# To avoid having to make the parent directory a module just amend PYTHONPATH
+# (once, as both test modules are usually loaded together).
+_PARENT_DIR = os.path.join(sys.path[0], '..')
+if _PARENT_DIR not in sys.path:
+    sys.path.insert(1, _PARENT_DIR)
 import backup
 import test
 
@@ -45,8 +49,48 @@ class TestBackupMethods(unittest.TestCase):
     _FILE_TYPE_DIR = 'directory'
     _FILE_TYPE_GPG = 'PGP RSA encrypted session key - keyid: A294AFC5 ' \
                      'A32F6F37 RSA (Encrypt or Sign) 1024b .'
+    _FILE_TYPE_GPG_SYMMETRIC = 'GPG symmetrically encrypted data ' \
+                               '(AES256 cipher)'
     _FILE_TYPE_TAR = 'POSIX tar archive (GNU)'
     _FILE_TYPE_XZ = 'XZ compressed data'
+    _FILE_TYPE_ZSTD = 'Zstandard compressed data (v0.8+), Dictionary ID: None'
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Creates the root temporary directory which each test's temporary
+        directory is made within. Then creates the testing files and directory
+        structure once, in a cache directory within it which the tests copy
+        their inputs from, and hashes them. Also starts the threads which
+        remove each test's temporary directory in the background, while the
+        next test runs, and the gpg-agent the encryption tests share.
+        """
+        test.start_gpg_agent()
+        cls._cleanup_pool = multiprocessing.pool.ThreadPool(2)
+        cls._root = tempfile.mkdtemp(dir=test.TMP_ROOT)
+        cls._cache_dir = os.path.join(cls._root, 'cache')
+        os.makedirs(cls._cache_dir)
+        cls._cache_ascii = os.path.join(cls._cache_dir, 'ascii.txt')
+        cls._cache_binary = os.path.join(cls._cache_dir, 'binary.bin')
+        cls._cache_struct = os.path.join(cls._cache_dir, 'struct')
+        test.create_ascii_file(cls._cache_ascii)
+        test.create_binary_file(cls._cache_binary)
+        test.create_test_structure(cls._cache_struct)
+        cls._cache_ascii_hash = test.get_file_hash(cls._cache_ascii)
+        cls._cache_binary_hash = test.get_file_hash(cls._cache_binary)
+        cls._cache_struct_hash = test.get_dir_hash(cls._cache_struct)
+
+    @classmethod
+    def tearDownClass(cls):
+        """
+        Stops the gpg-agent and waits for the removal of every test's
+        temporary directory to finish, then removes the root temporary
+        directory created by setUpClass (and anything left within it).
+        """
+        test.stop_gpg_agent()
+        cls._cleanup_pool.close()
+        cls._cleanup_pool.join()
+        shutil.rmtree(cls._root)
 
     def _assert_file_processing(self, processing_func, unprocessing_func,
                                 processed_file_types, input_filename,
@@ -80,8 +124,9 @@ class TestBackupMethods(unittest.TestCase):
             processed_is_same:      boolean, True if the processed output is the
                 same as the input.
         """
+        assert isinstance(processed_file_types, list)
         try:
-            tempdir = tempfile.mkdtemp()
+            tempdir = tempfile.mkdtemp(dir=self._root)
             out_dir = os.path.join(tempdir, 'output')
             os.makedirs(out_dir)
 
@@ -91,18 +136,20 @@ class TestBackupMethods(unittest.TestCase):
 
             # Create the file.
             if is_ascii:
-                test.create_ascii_file(test_input)
+                cache_input = self._cache_ascii
                 input_file_type = self._FILE_TYPE_ASCII
+                test_input_hash = self._cache_ascii_hash
             else:
-                test.create_binary_file(test_input)
+                cache_input = self._cache_binary
                 input_file_type = self._FILE_TYPE_BINARY
+                test_input_hash = self._cache_binary_hash
+            shutil.copyfile(cache_input, test_input)
 
-            # Assert the starting state looks as we expect.
-            self.assertTrue(os.path.isfile(test_input))
-            self.assertFalse(os.path.exists(test_processed))
-            self.assertFalse(os.path.exists(test_output))
+            # Assert the starting state looks as we expect (with one listing, as
+            # the output directory was only just created).
+            self.assertEqual(sorted([input_filename, 'output']),
+                             sorted(os.listdir(tempdir)))
             self.assertEqual(input_file_type, test.get_file_type(test_input))
-            test_input_hash = test.get_file_md5(test_input)
 
             # Perform the processing operation on the file.
             processing_func(test_processed, test_input)
@@ -112,13 +159,13 @@ class TestBackupMethods(unittest.TestCase):
             self.assertTrue(os.path.isfile(test_processed))
             self.assertFalse(os.path.exists(test_output))
             self.assertEqual(input_file_type, test.get_file_type(test_input))
-            self.assertEqual(test_input_hash, test.get_file_md5(test_input))
+            self.assertTrue(test.files_equal(cache_input, test_input))
             self.assertIn(test.get_file_type(test_processed), processed_file_types)
-            test_processed_hash = test.get_file_md5(test_processed)
-            self.assertEqual(32, len(test_processed_hash))
             if processed_is_same:
-                self.assertEqual(test_input_hash, test_processed_hash)
+                self.assertTrue(test.files_equal(cache_input, test_processed))
             else:
+                test_processed_hash = test.get_file_hash(test_processed)
+                self.assertEqual(test.HASH_HEX_LENGTH, len(test_processed_hash))
                 self.assertNotEqual(test_input_hash, test_processed_hash)
 
             # Delete the file (so we can check it doesn't get recreated).
@@ -134,12 +181,10 @@ class TestBackupMethods(unittest.TestCase):
             self.assertTrue(os.path.isfile(test_processed))
             self.assertTrue(os.path.isfile(test_output))
             self.assertEqual(input_file_type, test.get_file_type(test_output))
-            self.assertEqual(test_input_hash, test.get_file_md5(test_output))
-            self.assertIn(test.get_file_type(test_processed), processed_file_types)
-            self.assertEqual(test_processed_hash, test.get_file_md5(test_processed))
+            self.assertTrue(test.files_equal(cache_input, test_output))
 
         finally:
-            shutil.rmtree(tempdir)
+            self._cleanup_pool.apply_async(shutil.rmtree, (tempdir, True))
 
     def _assert_dir_processing(self, processing_func, unprocessing_func,
                                processed_file_types, input_dirname,
@@ -174,8 +219,9 @@ class TestBackupMethods(unittest.TestCase):
             processed_is_same:      boolean, True if the processed output is the
                 same as the input.
         """
+        assert isinstance(processed_file_types, list)
         try:
-            tempdir = tempfile.mkdtemp()
+            tempdir = tempfile.mkdtemp(dir=self._root)
             in_dir = os.path.join(tempdir, 'input')
             prc_dir = os.path.join(tempdir, 'processed')
             out_dir = os.path.join(tempdir, 'output')
@@ -187,15 +233,16 @@ class TestBackupMethods(unittest.TestCase):
             test_processed = os.path.join(prc_dir, processed_dirname)
             test_output = os.path.join(out_dir, output_dirname)
 
-            # Create the structure.
-            test.create_test_structure(test_input)
+            # Create the structure. It is copied rather than hardlinked so a
+            # processing function modifying its input cannot corrupt the cache.
+            shutil.copytree(self._cache_struct, test_input)
+            test_input_hash = self._cache_struct_hash
 
             # Assert the starting state looks as we expect.
             self.assertTrue(os.path.isdir(test_input))
             self.assertFalse(os.path.exists(test_processed))
             self.assertFalse(os.path.exists(test_output))
             self.assertEqual(self._FILE_TYPE_DIR, test.get_file_type(test_input))
-            test_input_hash = test.get_dir_md5(test_input)
 
             # Perform the processing operation on the directory.
             processing_func(prc_dir if processed_is_dir else test_processed,
@@ -209,13 +256,13 @@ class TestBackupMethods(unittest.TestCase):
                 self.assertTrue(os.path.isfile(test_processed))
             self.assertFalse(os.path.exists(test_output))
             self.assertEqual(self._FILE_TYPE_DIR, test.get_file_type(test_input))
-            self.assertEqual(test_input_hash, test.get_dir_md5(test_input))
+            self.assertEqual(test_input_hash, test.get_dir_hash(test_input))
             self.assertIn(test.get_file_type(test_processed), processed_file_types)
             if processed_is_dir:
-                test_processed_hash = test.get_dir_md5(test_processed)
+                test_processed_hash = test.get_dir_hash(test_processed)
             else:
-                test_processed_hash = test.get_file_md5(test_processed)
-            self.assertEqual(32, len(test_processed_hash))
+                test_processed_hash = test.get_file_hash(test_processed)
+            self.assertEqual(test.HASH_HEX_LENGTH, len(test_processed_hash))
             if processed_is_same:
                 self.assertEqual(test_input_hash, test_processed_hash)
             else:
@@ -237,15 +284,10 @@ class TestBackupMethods(unittest.TestCase):
                 self.assertTrue(os.path.isfile(test_processed))
             self.assertTrue(os.path.isdir(test_output))
             self.assertEqual(self._FILE_TYPE_DIR, test.get_file_type(test_output))
-            self.assertEqual(test_input_hash, test.get_dir_md5(test_output))
-            self.assertIn(test.get_file_type(test_processed), processed_file_types)
-            if processed_is_dir:
-                self.assertEqual(test_processed_hash, test.get_dir_md5(test_processed))
-            else:
-                self.assertEqual(test_processed_hash, test.get_file_md5(test_processed))
+            self.assertEqual(test_input_hash, test.get_dir_hash(test_output))
 
         finally:
-            shutil.rmtree(tempdir)
+            self._cleanup_pool.apply_async(shutil.rmtree, (tempdir, True))
 
 
     def test_archive_path_ascii_file(self):
@@ -280,6 +322,14 @@ class TestBackupMethods(unittest.TestCase):
                                      [self._FILE_TYPE_XZ], 'testfile.bin',
                                      'compressed.xz', 'testfile.bin', False)
 
+    def test_compress_path_threaded(self):
+        """Test the compress methods using one thread per core."""
+        compress = lambda d, s: backup.compress_path(d, s, threads=0)
+        uncompress = lambda d, s: backup.uncompress_path(d, s, threads=0)
+        self._assert_file_processing(compress, uncompress,
+                                     [self._FILE_TYPE_XZ], 'testfile.txt',
+                                     'threaded.xz', 'testfile.txt', True)
+
     def test_encrypt_path_ascii_file(self):
         """Test the encrypt methods with an ASCII file path argument."""
         # Wrap the backup.xcrypt_path functions so we can inject the unittesting
@@ -304,30 +354,90 @@ class TestBackupMethods(unittest.TestCase):
                                      'testfile.bin', 'encrypted.gpg',
                                      'testfile.bin', False)
 
+    def test_encrypt_path_symmetric(self):
+        """Test the encrypt methods encrypting with a passphrase file."""
+        encrypt = lambda d, s: backup.encrypt_path(
+            d, s, homedir=test.GPG_HOME, passphrase_file=test.PASSPHRASE_FILE)
+        unencrypt = lambda d, s: backup.unencrypt_path(
+            d, s, homedir=test.GPG_HOME, passphrase_file=test.PASSPHRASE_FILE)
+        self._assert_file_processing(encrypt, unencrypt,
+                                     [self._FILE_TYPE_GPG_SYMMETRIC],
+                                     'testfile.txt', 'symmetric.gpg',
+                                     'testfile.txt', True)
+
+    def test_compress_path_zstd(self):
+        """Test the compress methods using zstd."""
+        compress = lambda d, s: backup.compress_path(d, s, compressor='zstd')
+        uncompress = lambda d, s: backup.uncompress_path(d, s,
+                                                         compressor='zstd')
+        self._assert_file_processing(compress, uncompress,
+                                     [self._FILE_TYPE_ZSTD], 'testfile.txt',
+                                     'testfile.zst', 'testfile.txt', True)
+
+    def test_pipeline_path_ascii_file(self):
+        """Test the pipeline method compressing an ASCII file path argument."""
+        pipeline = lambda d, s: backup.pipeline_path(d, s, compress=True)
+        self._assert_file_processing(pipeline, backup.uncompress_path,
+                                     [self._FILE_TYPE_XZ], 'testfile.txt',
+                                     'testfile.xz', 'testfile.txt', True)
+
+    def test_pipeline_path_directory(self):
+        """Test the pipeline method archiving and compressing a directory."""
+        def unpipeline(dest, src):
+            """Uncompresses and unarchives src into dest."""
+            tar_path = os.path.splitext(src)[0]
+            backup.uncompress_path(tar_path, src)
+            backup.unarchive_path(dest, tar_path)
+        pipeline = lambda d, s: backup.pipeline_path(d, s, archive=True,
+                                                     compress=True)
+        self._assert_dir_processing(pipeline, unpipeline, [self._FILE_TYPE_XZ],
+                                    'struct', 'dir.tar.xz', 'struct',
+                                    output_is_dir=True)
+
     def test_copy_path_ascii_file(self):
         """Test the copy methods with an ASCII file path argument."""
         self._assert_file_processing(backup.copy_path, backup.copy_path,
-                                     self._FILE_TYPE_ASCII, 'original.txt',
+                                     [self._FILE_TYPE_ASCII], 'original.txt',
                                      'first.txt', 'second.txt', True,
                                      processed_is_same=True)
 
     def test_copy_path_binary_file(self):
         """Test the copy methods with a binary file path argument."""
         self._assert_file_processing(backup.copy_path, backup.copy_path,
-                                     self._FILE_TYPE_BINARY, 'original.bin',
+                                     [self._FILE_TYPE_BINARY], 'original.bin',
                                      'copied.bin', 'original.bin', False,
                                      processed_is_same=True)
 
     def test_copy_path_directory(self):
         """Test the copy methods with a directory path argument."""
         self._assert_dir_processing(backup.copy_path, backup.copy_path,
-                                    self._FILE_TYPE_DIR, 'struct',
+                                    [self._FILE_TYPE_DIR], 'struct',
                                     'struct', 'struct', processed_is_dir=True,
                                     output_is_dir=True, processed_is_same=True)
 
+    def test_reserve_out_filename(self):
+        """Test backup.reserve_out_filename never reuses a name."""
+        tempdir = tempfile.mkdtemp(dir=self._root)
+        paths = [backup.reserve_out_filename(tempdir, '/some/file', 'tar')
+                 for _ in range(3)]
+        # Each name is new, and they sort in the order they were reserved.
+        self.assertEqual(3, len(set(paths)))
+        self.assertEqual(sorted(paths), paths)
+        for path in paths:
+            self.assertTrue(os.path.basename(path).startswith('file.'))
+            self.assertTrue(path.endswith('.tar'))
+            self.assertEqual(0, os.path.getsize(path))
+        self._cleanup_pool.apply_async(shutil.rmtree, (tempdir, True))
+
+class TestBackupPureFunctions(unittest.TestCase):
+    """
+    Unit tests TestCase for backup's pure functions, which need none of the
+    testing files or tools, so have no class fixtures.
+    """
+
     def test_resolve_relative_path(self):
         """Test backup.resolve_relative_path"""
-        root_path = '/root/config.cfg'
+        root_path = '/root'
         abs_path = '/some/path'
         rel_path = 'relative/path'
         self.assertTrue(os.path.isabs(root_path))
@@ -346,3 +456,8 @@ class TestBackupMethods(unittest.TestCase):
         out_file2 = backup.get_out_filename(src_file, base_dir, 'x')
         self.assertEqual('/root/dir/filename.txt', out_file1)
         self.assertEqual('/some/filename/dir.x', out_file2)
+
+# Entry point, running just the unit tests (in parallel, as test.py does).
+if __name__ == "__main__":
+    sys.exit(0 if test.run_parallel(TestBackupPureFunctions) and
+             test.run_parallel(TestBackupMethods) else 1)